@@ -0,0 +1,558 @@
+"""
+Load benchmark for the web app.
+
+Serves main.py's routes in-process from an in-memory stand-in for the
+db module, seeded with a synthetic site, and requests each scenario
+with a fixed concurrency. Prints requests/sec and p50/p99 latency as
+JSON, so runs at different commits can be diffed.
+
+The stand-in answers instantly, so the numbers measure the handlers,
+templates and caches rather than RethinkDB. It only replaces storage:
+documents, scores and cursors come from the db module itself. A run
+with any failed requests exits non-zero instead of printing timings.
+
+Usage: python benchmarks/load.py [videos=5000] [users=500] [tags=200]
+    [requests=500] [concurrency=10] [seed=1] [scenarios=index,video,...]
+"""
+import bisect
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+import uuid
+
+import tornado.concurrent
+import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import db
+
+
+def resolved(value):
+    future = tornado.concurrent.Future()
+    future.set_result(value)
+    return future
+
+
+class FakeDb(object):
+    """
+    Implements the parts of the db module the handlers call, on plain
+    dictionaries. Reads return copies like the real driver does.
+    """
+    utc = db.utc
+    sort_orders = db.sort_orders
+    listing_fields = db.listing_fields
+    unix_time = staticmethod(db.unix_time)
+    video_doc = staticmethod(db.video_doc)
+    video_update_scores = staticmethod(db.video_update_scores)
+    videos_cursor = staticmethod(db.videos_cursor)
+
+    def __init__(self):
+        self.videos_version = 0
+        self.settings = {
+            'id': 'settings',
+            'motd': 'welcome to nohuck!',
+            'about': 'https://github.com/csytan/nohuck',
+            'cookie_secret': str(uuid.uuid4()),
+            'youtube_api_key': None
+        }
+        self.users = {}
+        self.videos = {}
+        self.comments = {}
+        self.votes = set()
+        self.tag_counts = {}
+        self.next_id = 1
+        self._orders = {}
+
+    def generate_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def videos_changed(self):
+        self.videos_version += 1
+
+    # Users
+    def user_get(self, username, password=None, cached=True):
+        user = self.users.get(username)
+        return resolved(dict(user) if user else None)
+
+    def user_save(self, user):
+        self.users[user['id']] = dict(user)
+        return resolved(user)
+
+    def user_add_karma(self, id):
+        if id in self.users:
+            self.users[id]['karma'] += 1
+        return resolved(None)
+
+    def user_hash_password(self, raw_password, n_iter=None):
+        return resolved('plain$' + raw_password)
+
+    def user_check_password(self, hashed_password, raw_password):
+        return resolved(hashed_password == 'plain$' + raw_password)
+
+    def user_password_outdated(self, hashed_password):
+        return False
+
+    def users_fetch(self, after=None, limit=100):
+        users = sorted(({'id': u['id'], 'karma': u['karma']}
+            for u in self.users.values()),
+            key=lambda user: (user['karma'], user['id']), reverse=True)
+        return resolved(users[:limit])
+
+    def settings_get(self):
+        return resolved(dict(self.settings))
+
+    # Videos
+    def _count_tags(self, tags, n):
+        for tag in tags:
+            self.tag_counts[tag] = self.tag_counts.get(tag, 0) + n
+            if not self.tag_counts[tag]:
+                del self.tag_counts[tag]
+
+    def _put_video(self, video, old_tags=()):
+        self.video_update_scores(video)
+        self.videos[video['id']] = video
+        self._count_tags(old_tags, -1)
+        self._count_tags(video['tags'], 1)
+        self._orders = {}
+
+    def _key(self, video, sort):
+        value = video[self.sort_orders.get(sort, sort)]
+        if isinstance(value, datetime.datetime):
+            value = self.unix_time(value)
+        return (value, video['id'])
+
+    def _order(self, sort):
+        if sort not in self._orders:
+            self._orders[sort] = sorted(self._key(v, sort)
+                for v in self.videos.values())
+        return self._orders[sort]
+
+    def video_create(self, title, text, thumbnail, video_ids, video_type,
+        points=1, ip_likes=[], user_likes=[], user_id=None, feed=None):
+        video = self.video_doc(self.generate_id(), title, text, thumbnail,
+            video_ids, video_type, points, user_id, feed)
+        self._put_video(video)
+        for ip in ip_likes:
+            self.votes.add((video['id'], 'ip:' + ip))
+        self.videos_changed()
+        return resolved(dict(video))
+
+    def videos_get(self, id):
+        video = self.videos.get(id)
+        return resolved(dict(video) if video else None)
+
+    def video_save(self, video):
+        old = self.videos[video['id']]
+        self._put_video(dict(video), old['tags'])
+        self.videos_changed()
+        return resolved(dict(video))
+
+    def video_delete(self, id):
+        video = self.videos.pop(id, None)
+        if video:
+            self._count_tags(video['tags'], -1)
+            self._orders = {}
+            self.videos_changed()
+        return resolved(bool(video))
+
+    def videos_fetch(self, tags, sort, after=None):
+        keys = self._order(sort)
+        end = len(keys)
+        if after:
+            end = bisect.bisect_left(keys, tuple(db.cursor_decode(after, sort)))
+        videos = []
+        for value, id in itertools.islice(reversed(keys), len(keys) - end, None):
+            video = self.videos[id]
+            if not all(tag in video['tags'] for tag in tags):
+                continue
+            videos.append(dict(video))
+            if len(videos) == 20:
+                break
+        return resolved(videos)
+
+    def videos_fetch_dupes(self, video_ids):
+        dupes = {}
+        for video in self.videos.values():
+            for id in video['video_ids']:
+                if (video['video_type'], id) in video_ids:
+                    dupes[(video['video_type'], id)] = video['id']
+        return resolved(dupes)
+
+    def videos_tag_counts(self, filter_tags=[]):
+        if not filter_tags:
+            return resolved(dict(self.tag_counts))
+        counts = {}
+        for video in self.videos.values():
+            if all(tag in video['tags'] for tag in filter_tags):
+                for tag in video['tags']:
+                    if tag not in filter_tags:
+                        counts[tag] = counts.get(tag, 0) + 1
+        return resolved(counts)
+
+    def _page(self, videos, sort, after, limit):
+        keys = sorted(self._key(v, sort) for v in videos)
+        if after:
+            keys = keys[:bisect.bisect_left(keys, tuple(db.cursor_decode(after, sort)))]
+        return [dict(self.videos[id]) for value, id in reversed(keys[-limit:])]
+
+    def videos_submitted_by(self, username, after=None, limit=20):
+        videos = [v for v in self.videos.values() if v['user_id'] == username]
+        return resolved(self._page(videos, 'hot', after, limit))
+
+    def videos_favorites(self, username, after=None, limit=20):
+        # Votes aren't timed here, the video's created time stands in
+        voter = 'user:' + username
+        videos = [dict(v, liked=v['created']) for v in self.videos.values()
+            if (v['id'], voter) in self.votes]
+        videos = self._page(videos, 'liked', after, limit)
+        for video in videos:
+            video['liked'] = video['created']
+        return resolved(videos)
+
+    # Votes
+    def video_like(self, id, ip, user_id=None, force=False):
+        voters = ['ip:' + ip] + (['user:' + user_id] if user_id else [])
+        new = [(id, voter) for voter in voters if (id, voter) not in self.votes]
+        self.votes.update(new)
+        if not new and not force:
+            return resolved(None)
+        video = self.videos[id]
+        video['points'] += 1
+        self._put_video(video)
+        return resolved(dict(video))
+
+    def video_liked(self, id, ip):
+        return resolved((id, 'ip:' + ip) in self.votes)
+
+    # Comments
+    def comment_create(self, video, user, text, reply_to=None):
+        comment = {
+            'id': str(uuid.uuid4()),
+            'created': datetime.datetime.now(self.utc),
+            'user_id': user['id'],
+            'video_id': video['id'],
+            'reply_to': reply_to,
+            'points': 1,
+            'text': text
+        }
+        self.comments.setdefault(video['id'], []).append(comment)
+        self.videos_changed()
+        return resolved({'inserted': 1})
+
+    def comments_for_video(self, video_id):
+        return resolved([dict(c) for c in self.comments.get(video_id, [])])
+
+
+def zipf_weights(n, s=1.1):
+    return [1.0 / (i + 1) ** s for i in range(n)]
+
+
+def cumulative(weights):
+    total = 0
+    sums = []
+    for weight in weights:
+        total += weight
+        sums.append(total)
+    return sums
+
+
+def weighted_choice(rand, items, cumulative):
+    return items[bisect.bisect(cumulative, rand.random() * cumulative[-1])]
+
+
+def youtube_id(rand):
+    return ''.join(rand.choice(string.ascii_letters + string.digits + '-_')
+        for i in range(11))
+
+
+def seed(fake, rand, n_videos=5000, n_users=500, n_tags=200):
+    """
+    Fills fake with a site whose tag use, submitters, points and comment
+    counts follow long tailed distributions.
+    """
+    words = ('huck layout sky pull hammer flick zone stack cup mark '
+        'greatest callahan worlds nationals club college highlight').split()
+    now = datetime.datetime.now(fake.utc)
+
+    user_ids = ['user' + str(i) for i in range(n_users)]
+    for id in user_ids:
+        fake.users[id] = {
+            'id': id,
+            'created': now - datetime.timedelta(days=rand.randint(0, 1500)),
+            'password': 'plain$password',
+            'about': ' '.join(rand.choice(words) for w in range(20)),
+            'karma': int(rand.paretovariate(1.2)) + 40
+        }
+    user_weights = cumulative(zipf_weights(n_users))
+
+    tags = ['tag-' + str(i) for i in range(n_tags)]
+    tag_weights = cumulative(zipf_weights(n_tags))
+
+    for i in range(n_videos):
+        video_tags = set(weighted_choice(rand, tags, tag_weights)
+            for t in range(rand.randint(0, 4)))
+        submitter = weighted_choice(rand, user_ids, user_weights) \
+            if rand.random() < 0.3 else None
+        created = now - datetime.timedelta(seconds=rand.randint(0, 3 * 365 * 86400))
+        video = fake.video_doc(fake.generate_id(),
+            title=' '.join(rand.choice(words) for w in range(rand.randint(3, 10))),
+            text=' '.join(rand.choice(words) for w in range(rand.randint(0, 60))),
+            video_ids=[youtube_id(rand) for p in range(1 if rand.random() < 0.9 else 3)],
+            video_type='youtube',
+            thumbnail='https://i.ytimg.com/vi/' + youtube_id(rand) + '/hqdefault.jpg',
+            points=int(rand.paretovariate(1.5)),
+            user_id=submitter,
+            feed=None if submitter else 'reddit')
+        video.update(created=created, updated=created, tags=list(video_tags))
+        fake._put_video(video)
+
+        comments = []
+        for c in range(int(rand.expovariate(1 / 3.0))):
+            comment = {
+                'id': str(uuid.uuid4()),
+                'created': video['created'] + datetime.timedelta(minutes=c),
+                'user_id': weighted_choice(rand, user_ids, user_weights),
+                'video_id': video['id'],
+                'reply_to': rand.choice(comments)['id']
+                    if comments and rand.random() < 0.5 else None,
+                'points': 1,
+                'text': ' '.join(rand.choice(words) for w in range(rand.randint(3, 40)))
+            }
+            comments.append(comment)
+        fake.comments[video['id']] = comments
+        video['n_comments'] = len(comments)
+
+        voters = set(weighted_choice(rand, user_ids, user_weights)
+            for v in range(min(video['points'], 20)))
+        fake.votes.update((video['id'], 'user:' + voter) for voter in voters)
+    return tags, user_ids
+
+
+class Site(object):
+    """Builds the requests of each scenario"""
+    def __init__(self, fake, rand, base_url, tags, user_ids):
+        self.fake = fake
+        self.rand = rand
+        self.base_url = base_url
+        self.tags = tags
+        self.user_ids = user_ids
+        self.video_ids = sorted(fake.videos)
+        self.xsrf = uuid.uuid4().hex
+        secret = fake.settings['cookie_secret']
+        self.cookies = {id: tornado.web.create_signed_value(
+            secret, 'user', id).decode('ascii') for id in user_ids}
+
+    def request(self, path, user=None, body=None, **kwargs):
+        headers = {'X-Real-Ip': '10.%d.%d.%d' % tuple(
+            self.rand.randint(0, 255) for i in range(3))}
+        cookie = '_xsrf=' + self.xsrf
+        if user:
+            cookie += '; user=' + self.cookies[user]
+        headers['Cookie'] = cookie
+        if body is not None:
+            body['_xsrf'] = self.xsrf
+            body = '&'.join(k + '=' + tornado.escape.url_escape(v)
+                for k, v in body.items())
+        return tornado.httpclient.HTTPRequest(self.base_url + path,
+            method='POST' if body is not None else 'GET',
+            headers=headers, body=body, follow_redirects=False, **kwargs)
+
+    def user(self):
+        return self.rand.choice(self.user_ids)
+
+    def index(self):
+        sort = self.rand.choice(['hot', 'hot', 'hot', 'new', 'top'])
+        path = '/?sort=' + sort
+        if self.rand.random() < 0.3:
+            path = '/tags/' + self.rand.choice(self.tags[:20]) + '?sort=' + sort
+        return self.request(path)
+
+    def index_logged_in(self):
+        request = self.index()
+        return self.request(request.url[len(self.base_url):], user=self.user())
+
+    def video(self):
+        return self.request('/' + str(self.rand.choice(self.video_ids)))
+
+    def like(self):
+        return self.request('/' + str(self.rand.choice(self.video_ids)),
+            body={'action': 'like'})
+
+    def api(self):
+        sort = self.rand.choice(['hot', 'hot', 'hot', 'new', 'top'])
+        path = '/api/videos?sort=' + sort
+        if self.rand.random() < 0.3:
+            path += '&tag=' + self.rand.choice(self.tags[:20])
+        return self.request(path)
+
+    def tags_page(self):
+        return self.request('/tags')
+
+    def user_page(self):
+        return self.request('/@' + self.rand.choice(self.user_ids[:50]))
+
+    def submit(self):
+        return self.request('/submit', user=self.user(), body={
+            'action': 'submit',
+            'urls': 'https://youtu.be/' + youtube_id(self.rand),
+            'title': 'benchmark video',
+            'text': 'submitted by the load benchmark'
+        })
+
+    def scenarios(self):
+        return [
+            ('index', self.index),
+            ('index_logged_in', self.index_logged_in),
+            ('video', self.video),
+            ('api', self.api),
+            ('like', self.like),
+            ('tags', self.tags_page),
+            ('user', self.user_page),
+            ('submit', self.submit)
+        ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, i)]
+
+
+@tornado.gen.coroutine
+def run_scenario(client, make_request, n_requests, concurrency):
+    latencies = []
+    errors = [0]
+    remaining = iter(range(n_requests))
+
+    @tornado.gen.coroutine
+    def worker():
+        for i in remaining:
+            request = make_request()
+            start = time.time()
+            try:
+                yield client.fetch(request)
+            except tornado.httpclient.HTTPError as e:
+                # Redirects after a POST are the expected response
+                if e.code >= 400:
+                    errors[0] += 1
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for i in range(concurrency)]
+    elapsed = time.time() - start
+    latencies.sort()
+    raise tornado.gen.Return({
+        'requests': n_requests,
+        'errors': errors[0],
+        'rps': round(n_requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2)
+    })
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@tornado.gen.coroutine
+def fake_provider_data(video_ids):
+    raise tornado.gen.Return([{
+        'id': id,
+        'video_type': 'youtube',
+        'title': 'benchmark video',
+        'thumbnail': 'https://i.ytimg.com/vi/' + id + '/hqdefault.jpg'
+    } for id in video_ids])
+
+
+def main(args):
+    options = {
+        'videos': 5000,
+        'users': 500,
+        'tags': 200,
+        'requests': 500,
+        'concurrency': 10,
+        'seed': 1,
+        'scenarios': None
+    }
+    for arg in args:
+        key, value = arg.split('=', 1)
+        options[key] = value if key == 'scenarios' else int(value)
+
+    rand = random.Random(options['seed'])
+    fake = FakeDb()
+    tags, user_ids = seed(fake, rand, options['videos'], options['users'],
+        options['tags'])
+
+    # main looks db up when a handler runs, so the stand-in has to be
+    # in place before it's imported
+    sys.modules['db'] = fake
+    import main as app_module
+    import utils
+    utils.youtube_data_async = fake_provider_data
+    utils.vimeo_data_async = fake_provider_data
+    app_module.settings.update(fake.settings)
+
+    config = dict(app_module.config, debug=False,
+        cookie_secret=fake.settings['cookie_secret'])
+    app = tornado.web.Application(app_module.routes, **config)
+    sockets = tornado.netutil.bind_sockets(0, address='127.0.0.1')
+    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    server.add_sockets(sockets)
+    base_url = 'http://127.0.0.1:' + str(sockets[0].getsockname()[1])
+
+    site = Site(fake, rand, base_url, tags, user_ids)
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options['concurrency'])
+    selected = options['scenarios'].split(',') if options['scenarios'] else None
+
+    @tornado.gen.coroutine
+    def run_all():
+        results = {}
+        for name, make_request in site.scenarios():
+            if selected and name not in selected:
+                continue
+            # Warm the template and page caches first
+            yield run_scenario(client, make_request, options['concurrency'],
+                options['concurrency'])
+            results[name] = yield run_scenario(client, make_request,
+                options['requests'], options['concurrency'])
+        raise tornado.gen.Return(results)
+
+    results = tornado.ioloop.IOLoop.current().run_sync(run_all)
+    server.stop()
+    failed = sorted(name for name, result in results.items() if result['errors'])
+    if failed:
+        # Timings of failing requests would only be misleading
+        for name in failed:
+            sys.stderr.write('%s: %d of %d requests failed\n' % (
+                name, results[name]['errors'], results[name]['requests']))
+        sys.exit(1)
+    print(json.dumps({
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'tornado': tornado.version,
+        'options': options,
+        'scenarios': results
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+"""
+Checks utils.VideoIdScanner on known cases, split at every chunk
+boundary, then compares utils.video_ids_from_text with the original
+five regex version on a synthetic reddit listing.
+
+Usage: python benchmarks/video_ids.py [n_posts]
+"""
+import collections
+import json
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import utils
+
+
+def video_ids_from_text_legacy(text,
+    youtube_re=re.compile(r'\/watch\?\S*v=([\w\-]+)'),
+    youtube_re2=re.compile(r'youtu\.be\/([\w\-]+)'),
+    youtube_re3=re.compile(r'youtube\.com\/embed\/([\w\-]+)'),
+    vimeo_re=re.compile(r'vimeo\.com\/(\d+)'),
+    vimeo_re2=re.compile(r'player\.vimeo\.com\/video\/(\d+)')):
+    youtube_ids = youtube_re.findall(text) + \
+        youtube_re2.findall(text) + \
+        youtube_re3.findall(text)
+    youtube_ids = list(collections.OrderedDict.fromkeys(youtube_ids))
+
+    vimeo_ids = vimeo_re.findall(text) + vimeo_re2.findall(text)
+    vimeo_ids = list(collections.OrderedDict.fromkeys(vimeo_ids))
+
+    return [('youtube', id) for id in youtube_ids] + \
+        [('vimeo', id) for id in vimeo_ids]
+
+
+def reddit_page(n_posts, seed=1):
+    rand = random.Random(seed)
+    def youtube_id():
+        return ''.join(rand.choice(string.ascii_letters + '-_') for i in range(11))
+    urls = [
+        lambda: 'https://www.youtube.com/watch?v=' + youtube_id() + '&amp;feature=share',
+        lambda: 'https://youtu.be/' + youtube_id(),
+        lambda: 'https://www.youtube.com/embed/' + youtube_id(),
+        lambda: 'https://vimeo.com/' + str(rand.randint(10 ** 7, 10 ** 9)),
+        lambda: 'https://player.vimeo.com/video/' + str(rand.randint(10 ** 7, 10 ** 9)),
+        lambda: 'https://i.imgur.com/' + youtube_id() + '.jpg'
+    ]
+    words = 'huck layout sky pull hammer flick zone stack cup mark'.split()
+    posts = []
+    for i in range(n_posts):
+        posts.append({'kind': 't3', 'data': {
+            'title': ' '.join(rand.choice(words) for w in range(12)),
+            'selftext': ' '.join(rand.choice(words) for w in range(80)),
+            'url': rand.choice(urls)(),
+            'num_comments': rand.randint(0, 500)
+        }})
+    return json.dumps({'kind': 'Listing', 'data': {'children': posts}})
+
+
+# (text, ids the scanner should find, ids the original found if different)
+cases = [
+    ('https://www.youtube.com/watch?v=AAA', [('youtube', 'AAA')], None),
+    ('/watch?feature=share&v=AAA', [('youtube', 'AAA')], None),
+    ('/watch?feature=share&amp;v=AAA', [('youtube', 'AAA')], None),
+    # xv isn't the v parameter, and the quote ends the URL
+    ('/watch?xv=AAA', [], [('youtube', 'AAA')]),
+    ('<a href="/watch?a=1">b&v=AAA', [], [('youtube', 'AAA')]),
+    # v= is looked for in the first 200 characters of the query
+    ('/watch?a=' + 'x' * 189 + '&v=AAA', [('youtube', 'AAA')], None),
+    ('/watch?a=' + 'x' * 200 + '&v=AAA', [], [('youtube', 'AAA')]),
+    # The original only found the last id of a run without spaces
+    ('/watch?v=AAA,/watch?v=BBB', [('youtube', 'AAA'), ('youtube', 'BBB')],
+        [('youtube', 'BBB')]),
+    ('youtu.be/AAA https://youtube.com/watch?v=BBB',
+        [('youtube', 'BBB'), ('youtube', 'AAA')], None),
+    ('youtube.com/embed/CCC youtu.be/AAA youtu.be/CCC',
+        [('youtube', 'AAA'), ('youtube', 'CCC')], None),
+    ('player.vimeo.com/video/111 vimeo.com/222',
+        [('vimeo', '222'), ('vimeo', '111')], None),
+    ('vimeo.com/222 youtu.be/AAA',
+        [('youtube', 'AAA'), ('vimeo', '222')], None),
+]
+
+
+def check():
+    for text, expected, original in cases:
+        assert video_ids_from_text_legacy(text) == (original or expected), text
+        assert utils.video_ids_from_text(text) == expected, text
+        for i in range(len(text) + 1):
+            scanner = utils.VideoIdScanner()
+            scanner.feed(text[:i])
+            scanner.feed(text[i:])
+            assert scanner.close() == expected, (text, i)
+        scanner = utils.VideoIdScanner()
+        for c in text:
+            scanner.feed(c)
+        assert scanner.close() == expected, text
+    # An id cut off by max_bytes is dropped
+    scanner = utils.VideoIdScanner(max_bytes=22)
+    scanner.feed('youtu.be/AAA youtu.be/BBBBBB')
+    assert scanner.full and scanner.close() == [('youtube', 'AAA')]
+
+
+def stream(text, chunk_size=16 * 1024):
+    scanner = utils.VideoIdScanner()
+    for i in range(0, len(text), chunk_size):
+        scanner.feed(text[i:i + chunk_size])
+    return scanner.close()
+
+
+if __name__ == '__main__':
+    check()
+    n_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    text = reddit_page(n_posts)
+    print('page: ' + str(len(text)) + ' bytes, ' + str(n_posts) + ' posts')
+
+    legacy = video_ids_from_text_legacy(text)
+    assert utils.video_ids_from_text(text) == legacy
+    assert stream(text) == legacy
+
+    for name, function in [
+        ('legacy', video_ids_from_text_legacy),
+        ('whole text', utils.video_ids_from_text),
+        ('streamed', stream)]:
+        seconds = min(timeit.repeat(lambda: function(text), number=5, repeat=3)) / 5
+        print('%-12s %8.2f ms' % (name, seconds * 1000))
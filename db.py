@@ -1,22 +1,210 @@
+import base64
+import binascii
+import bisect
+import collections
+import concurrent.futures
 import datetime
 import hashlib
+import hmac
+import importlib
+import itertools
+import json
 import logging
 import re
+import time
 import uuid
 
 import tornado.gen
+import tornado.ioloop
+import tornado.locks
 import rethinkdb as r
 
 import utils
 
 
 
-r.connect('localhost', 28015).repl()
+r.set_loop_type('tornado')
 db = r.db('nohuck')
 utc = r.make_timezone('00:00')
+sort_orders = {'hot': 'score', 'top': 'top_score', 'new': 'created'}
+
+
+### Connections ###
+class ConnectionPool(object):
+    """
+    A bounded pool of RethinkDB connections for the Tornado IOLoop.
+
+    Connections are opened lazily, checked before they are handed out
+    and dropped if the server has closed them, so the next query simply
+    reconnects.
+    """
+    def __init__(self, host='localhost', port=28015, size=10, max_idle=60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = collections.deque()
+        self._slots = tornado.locks.Semaphore(size)
+
+    @tornado.gen.coroutine
+    def acquire(self):
+        yield self._slots.acquire()
+        try:
+            conn = yield self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        raise tornado.gen.Return(conn)
+
+    @tornado.gen.coroutine
+    def _checkout(self):
+        while self._idle:
+            conn, released = self._idle.pop()
+            if not conn.is_open():
+                continue
+            if time.time() - released > self.max_idle:
+                # Ping connections that have been idle for a while, the
+                # server or a proxy may have dropped them silently.
+                try:
+                    yield r.expr(1).run(conn)
+                except r.ReqlDriverError:
+                    conn.close(noreply_wait=False)
+                    continue
+            raise tornado.gen.Return(conn)
+        conn = yield r.connect(self.host, self.port)
+        raise tornado.gen.Return(conn)
+
+    def release(self, conn):
+        if conn.is_open():
+            self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    @tornado.gen.coroutine
+    def run(self, query, name='query'):
+        """
+        Runs query on a pooled connection, reading cursors into lists.
+        The time taken, waiting for a connection included, is recorded
+        under name and queries slower than slow_query_seconds are logged.
+        """
+        start = time.time()
+        conn = yield self.acquire()
+        try:
+            result = yield query.run(conn)
+            if hasattr(result, 'fetch_next'):
+                items = []
+                while (yield result.fetch_next()):
+                    item = yield result.next()
+                    items.append(item)
+                result = items
+        except r.ReqlDriverError:
+            conn.close(noreply_wait=False)
+            raise
+        finally:
+            self.release(conn)
+            elapsed = time.time() - start
+            utils.metrics.observe('db_query_seconds', elapsed, query=name)
+            if elapsed > slow_query_seconds:
+                logging.warning('slow query in ' + name + ' (%.3fs): %.500s',
+                    elapsed, query)
+        raise tornado.gen.Return(result)
+
+    def close(self):
+        while self._idle:
+            conn, released = self._idle.pop()
+            conn.close(noreply_wait=False)
+
+
+slow_query_seconds = 0.25
+pool = ConnectionPool()
+
+
+def run(query, name):
+    """Runs query on the pool, recording its time under name"""
+    return pool.run(query, name)
+
+
+
+### Setup ###
+tables = ['settings', 'users', 'videos', 'comments', 'feeds', 'tags', 'votes',
+    'jobs']
+
+# (table, index name, index function, index_create options)
+indexes = [
+    ('videos', 'score', None, {}),
+    ('videos', 'top_score', None, {}),
+    ('videos', 'created', None, {}),
+    ('videos', 'tags', None, {'multi': True}),
+    ('videos', 'score_id',
+        lambda video: [video['score'], video['id']], {}),
+    ('videos', 'top_score_id',
+        lambda video: [video['top_score'], video['id']], {}),
+    ('videos', 'created_id',
+        lambda video: [video['created'], video['id']], {}),
+    ('videos', 'tag_score_id',
+        lambda video: video['tags'].map(
+            lambda tag: [tag, video['score'], video['id']]),
+        {'multi': True}),
+    ('videos', 'tag_top_score_id',
+        lambda video: video['tags'].map(
+            lambda tag: [tag, video['top_score'], video['id']]),
+        {'multi': True}),
+    ('videos', 'tag_created_id',
+        lambda video: video['tags'].map(
+            lambda tag: [tag, video['created'], video['id']]),
+        {'multi': True}),
+    ('users', 'karma_id',
+        lambda user: [user['karma'], user['id']], {}),
+    ('videos', 'user_score_id',
+        lambda video: [video['user_id'], video['score'], video['id']], {}),
+    ('videos', 'video_ids',
+        lambda video: video['video_ids'].map(
+            lambda id: [video['video_type'], id]),
+        {'multi': True}),
+    ('votes', 'video_id', None, {}),
+    ('votes', 'voter_created',
+        lambda vote: [vote['voter'], vote['created'], vote['video_id']], {}),
+    ('comments', 'video_id_created',
+        lambda comment: [comment['video_id'], comment['created']], {}),
+    ('feeds', 'next_update', None, {}),
+    ('jobs', 'status', None, {}),
+    ('jobs', 'created', None, {})
+]
+
+
+@tornado.gen.coroutine
+def setup():
+    """Creates any missing tables and indexes and rebuilds tag counts"""
+    if 'nohuck' not in (yield run(r.db_list(), 'setup')):
+        yield run(r.db_create('nohuck'), 'setup')
+
+    existing = yield run(db.table_list(), 'setup')
+    for table in tables:
+        if table not in existing:
+            logging.info('creating table: ' + table)
+            yield run(db.table_create(table), 'setup')
+
+    for table, name, function, options in indexes:
+        if name not in (yield run(db.table(table).index_list(), 'setup')):
+            logging.info('creating index: ' + table + '.' + name)
+            args = (name, function) if function is not None else (name,)
+            yield run(db.table(table).index_create(*args, **options), 'setup')
+    for table in tables:
+        yield run(db.table(table).index_wait(), 'setup')
+
+    settings = yield settings_get()
+    if not settings:
+        yield settings_create()
+    elif not settings.get('metrics_token'):
+        settings['metrics_token'] = str(uuid.uuid4())
+        yield settings_save(settings)
+        logging.info('added a metrics_token to the settings')
+    yield votes_migrate()
+    yield top_scores_migrate()
+    yield tag_counts_rebuild()
 
 
 ### Settings ###
+@tornado.gen.coroutine
 def settings_create():
     #db.table_create('settings').run()
     settings = {
@@ -24,101 +212,308 @@ def settings_create():
         'motd': 'welcome to nohuck!',
         'about': 'https://github.com/csytan/nohuck',
         'cookie_secret': str(uuid.uuid4()),
+        'metrics_token': str(uuid.uuid4()),
         'youtube_api_key': None
     }
     id_counter = {
         'id': 'id_counter',
         'value': 4044
     }
-    (db.table('settings')
-        .insert([settings, id_counter])
-        .run())
-    return settings
+    yield run(db.table('settings')
+        .insert([settings, id_counter]), 'settings_create')
+    raise tornado.gen.Return(settings)
 
 
 def settings_get():
-    return db.table('settings').get('settings').run()
+    return run(db.table('settings').get('settings'), 'settings_get')
 
 
 def settings_save(settings):
-    return (db.table('settings')
-        .replace(settings)
-        .run())
+    return run(db.table('settings')
+        .replace(settings), 'settings_save')
+
+class IdAllocator(object):
+    """
+    Hands out ids from blocks reserved on the settings id_counter.
+
+    Each reservation is one atomic increment of the counter by
+    block_size, so processes never share a block and only every
+    block_size-th id costs a database round-trip. Ids are increasing
+    within a process, unused ids in a block are skipped on restart.
+    """
+    def __init__(self, counter_id='id_counter', block_size=10):
+        self.counter_id = counter_id
+        self.block_size = block_size
+        self._next = 1
+        self._last = 0
+        self._lock = tornado.locks.Lock()
+
+    @tornado.gen.coroutine
+    def allocate(self):
+        with (yield self._lock.acquire()):
+            if self._next > self._last:
+                yield self._reserve()
+            id = self._next
+            self._next += 1
+        raise tornado.gen.Return(id)
+
+    @tornado.gen.coroutine
+    def _reserve(self):
+        result = yield run(db.table('settings')
+            .get(self.counter_id)
+            .update({'value': r.row['value'].add(self.block_size)},
+                return_changes=True), 'IdAllocator._reserve')
+        change = result['changes'][0]
+        self._next = change['old_val']['value'] + 1
+        self._last = change['new_val']['value']
+
+
+id_allocator = IdAllocator()
+
 
 def generate_id():
-    return (db.table('settings')
-        .get('id_counter')
-        .update({'value': r.row['value'].add(1) }, return_changes=True)
-        .run()
-        ['changes'][0]['new_val']['value'])
+    return id_allocator.allocate()
+
+
+
+### Cursors ###
+def cursor_encode(order, value, id):
+    """
+    Returns an opaque token for the position (value, id) in a list in
+    order, e.g. a sort order.
+    """
+    token = json.dumps([order, value, id])
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+def cursor_decode(token, order):
+    """Returns the (value, id) position of a cursor_encode token for order"""
+    try:
+        token = base64.urlsafe_b64decode(token.encode('ascii'))
+        token_order, value, id = json.loads(token.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if token_order != order:
+        raise ValueError('cursor is for a different order')
+    return value, id
 
 
 
 ### Users ###
+@tornado.gen.coroutine
 def user_create(username, password):
     username = ''.join(c for c in username.lower()[:20] if c.isalnum() or c in '-_')
+    password = yield user_hash_password(password)
     user = {
         'id': username,
         'created': datetime.datetime.now(utc),
-        'password': user_hash_password(password),
+        'password': password,
         'about': 'Nothing here yet.',
         'karma': 1
     }
-    return (db.table('users')
-        .insert(user, return_changes=True)
-        .run()
-        ['changes'][0]['new_val'])
+    result = yield run(db.table('users')
+        .insert(user, return_changes=True), 'user_create')
+    leaderboard.update(user)
+    raise tornado.gen.Return(result['changes'][0]['new_val'])
+
+
+# Users looked up for sessions, writes through this module invalidate
+# them, other processes see changes once the ttl runs out.
+user_cache = utils.LRUCache(max_size=1000, ttl=60)
 
 
-def user_get(username, password=None):
-    return db.table('users').get(username).run()
+@tornado.gen.coroutine
+def user_get(username, password=None, cached=True):
+    user = user_cache.get(username) if cached else None
+    if user is None:
+        user = yield run(db.table('users').get(username), 'user_get')
+        if user:
+            user_cache.set(username, user)
+    raise tornado.gen.Return(dict(user) if user else None)
 
 
+@tornado.gen.coroutine
 def user_save(user):
-    return (db.table('users')
+    result = yield run(db.table('users')
         .get(user['id'])
-        .replace(user, return_changes=True)
-        .run()
-        ['changes'][0]['new_val'])
+        .replace(user, return_changes=True), 'user_save')
+    user_cache.delete(user['id'])
+    leaderboard.update(result['changes'][0]['new_val'])
+    raise tornado.gen.Return(result['changes'][0]['new_val'])
 
 
+@tornado.gen.coroutine
 def user_add_karma(id):
     logging.error(id)
-    return logging.info(db.table('users')
+    result = yield run(db.table('users')
         .get(id)
-        .update({'karma': r.row['karma'].add(1)}, return_changes=True)
-        .run()
-        ['changes'][0]['new_val']['karma'])
+        .update({'karma': r.row['karma'].add(1)}, return_changes=True),
+        'user_add_karma')
+    user_cache.delete(id)
+    if result['changes']:
+        user = result['changes'][0]['new_val']
+        leaderboard.update(user)
+        logging.info(user['karma'])
+
 
+# Hashing runs on a few threads so logins don't block the IOLoop,
+# pbkdf2_hmac releases the GIL while it works.
+password_iterations = 100000
+password_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-def user_hash_password(raw_password, n_iter=10000):
+
+def password_digest(algo, n_iter, salt, raw_password):
+    if algo == 'sha512':
+        # Legacy hashes, checked so they can be upgraded on login
+        hsh = raw_password.encode('utf-8')
+        for i in range(n_iter):
+            hsh = hashlib.sha512(salt + hsh).hexdigest()
+        return hsh
+    hsh = hashlib.pbkdf2_hmac('sha256', raw_password.encode('utf-8'),
+        salt.encode('ascii'), n_iter)
+    return binascii.hexlify(hsh).decode('ascii')
+
+
+@tornado.gen.coroutine
+def user_hash_password(raw_password, n_iter=None):
     assert len(raw_password) > 0 and len(raw_password) <= 20
+    n_iter = n_iter or password_iterations
     salt = str(uuid.uuid4()).replace('-', '')
-    hsh = raw_password.encode('utf-8')
-    for i in range(n_iter):
-        hsh = hashlib.sha512(salt + hsh).hexdigest()
-    return 'sha512$' + str(n_iter) + '$' + salt + '$' + hsh
+    with utils.metrics.timer('password_hash_seconds', algo='pbkdf2_sha256'):
+        hsh = yield password_executor.submit(password_digest,
+            'pbkdf2_sha256', n_iter, salt, raw_password)
+    raise tornado.gen.Return(
+        'pbkdf2_sha256$' + str(n_iter) + '$' + salt + '$' + hsh)
 
 
+@tornado.gen.coroutine
 def user_check_password(hashed_password, raw_password):
     algo, n_iter, salt, check_hsh = hashed_password.split('$')
-    hsh = raw_password.encode('utf-8')
-    for i in range(int(n_iter)):
-        hsh = hashlib.sha512(salt + hsh).hexdigest()
-    return hsh == check_hsh
+    with utils.metrics.timer('password_hash_seconds', algo=algo):
+        hsh = yield password_executor.submit(password_digest,
+            algo, int(n_iter), salt, raw_password)
+    raise tornado.gen.Return(hmac.compare_digest(str(hsh), str(check_hsh)))
+
+
+def user_password_outdated(hashed_password):
+    algo, n_iter, salt, hsh = hashed_password.split('$')
+    return algo != 'pbkdf2_sha256' or int(n_iter) < password_iterations
+
+
+def users_by_karma(after=None, limit=100):
+    """
+    Returns a page of users by karma, highest first, with only their
+    id and karma. after is a users_cursor token.
+    """
+    upper = [r.maxval, r.maxval]
+    if after:
+        upper = list(cursor_decode(after, 'karma'))
+    return run(db.table('users')
+        .between([r.minval, r.minval], upper, index='karma_id',
+            right_bound='open')
+        .order_by(index=r.desc('karma_id'))
+        .limit(limit)
+        .pluck('id', 'karma'), 'users_by_karma')
+
+
+def users_cursor(user):
+    """Returns a token for the karma position just after user"""
+    return cursor_encode('karma', user['karma'], user['id'])
+
+
+class Leaderboard(object):
+    """
+    The size users with the most karma, kept in memory. Karma changes
+    made through this module move users in place, the list is reloaded
+    every ttl seconds for changes made by other processes.
+    """
+    def __init__(self, size=100, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._users = None
+        self._loaded = 0
+
+    @tornado.gen.coroutine
+    def top(self, limit):
+        if self._users is None or self._loaded + self.ttl < time.time():
+            self._users = yield users_by_karma(limit=self.size)
+            self._loaded = time.time()
+        raise tornado.gen.Return([dict(user) for user in self._users[:limit]])
+
+    def update(self, user):
+        if self._users is None:
+            return
+        old = [u for u in self._users if u['id'] == user['id']]
+        if old and old[0]['karma'] > user['karma']:
+            # Whoever is next in line isn't known, load them again
+            self._users = None
+            return
+        users = [u for u in self._users if u['id'] != user['id']]
+        users.append({'id': user['id'], 'karma': user['karma']})
+        users.sort(key=lambda u: (u['karma'], u['id']), reverse=True)
+        if len(self._users) == self.size:
+            # Only users known to be in the top size can be kept
+            users = users[:self.size]
+        self._users = users
+
+
+leaderboard = Leaderboard()
+
 
+@tornado.gen.coroutine
+def users_fetch(after=None, limit=100):
+    """Returns a page of users_by_karma, the first from leaderboard"""
+    if not after and limit <= leaderboard.size:
+        users = yield leaderboard.top(limit)
+    else:
+        users = yield users_by_karma(after, limit)
+    raise tornado.gen.Return(users)
 
-def users_fetch():
-    return list(db.table('users')
-        .order_by(r.desc('karma'))
-        .run())
 
 
 ### Videos ###
-def video_create(title, text, thumbnail, video_ids, video_type, 
-    points=1, ip_likes=[], user_likes=[], user_id=None, feed=None):
+# Bumped on writes that change listings or video pages, so rendered
+# copies of those pages can tell they're out of date. Writes made by
+# other processes bump it through videos_watch or the replica.
+videos_version = 0
+
+
+def videos_changed():
+    global videos_version
+    videos_version += 1
+
+
+@tornado.gen.coroutine
+def videos_watch(retry_delay=5):
+    """Bumps videos_version on every change to the videos table"""
+    while True:
+        conn = None
+        try:
+            conn = yield r.connect(pool.host, pool.port)
+            feed = yield db.table('videos').pluck('id').changes().run(conn)
+            while (yield feed.fetch_next()):
+                yield feed.next()
+                videos_changed()
+        except Exception:
+            logging.exception('videos changefeed failed')
+        finally:
+            if conn:
+                conn.close(noreply_wait=False)
+        # Changes may have been missed while the feed was down
+        videos_changed()
+        yield tornado.gen.sleep(retry_delay)
+
+
+# The fields of a video that listings show or are sorted by
+listing_fields = ('id', 'created', 'title', 'thumbnail', 'points', 'user_id',
+    'feed', 'n_comments', 'tags', 'score', 'top_score')
+
+
+def video_doc(id, title, text, thumbnail, video_ids, video_type, points=1,
+    user_id=None, feed=None):
+    """Returns a new video document with its scores set"""
     video = {
-        'id': generate_id(),
+        'id': id,
         'created': datetime.datetime.now(utc),
         'updated': datetime.datetime.now(utc),
         'user_id': user_id,
@@ -129,8 +524,6 @@ def video_create(title, text, thumbnail, video_ids, video_type,
         'video_type': video_type,
         'tags': [],
         'suggested_tags': [],
-        'ip_likes': ip_likes,
-        'user_likes': user_likes,
         'user_dislikes': [],
         'thumbnail': thumbnail,
         'n_comments': 0,
@@ -139,48 +532,177 @@ def video_create(title, text, thumbnail, video_ids, video_type,
         'top_score': 0
     }
     video_update_scores(video)
+    return video
 
-    q = (db.table('videos')
-        .insert(video)
-        .run())
-    return db.table('videos').get(video['id']).run()
+
+@tornado.gen.coroutine
+def video_create(title, text, thumbnail, video_ids, video_type, 
+    points=1, ip_likes=[], user_likes=[], user_id=None, feed=None):
+    id = yield generate_id()
+    video = video_doc(id, title, text, thumbnail, video_ids, video_type,
+        points, user_id, feed)
+
+    result = yield run(db.table('videos')
+        .insert(video, return_changes=True), 'video_create')
+    voters = ['ip:' + ip for ip in ip_likes] + ['user:' + id for id in user_likes]
+    if voters:
+        yield run(db.table('votes')
+            .insert([vote_doc(video['id'], voter) for voter in voters]),
+            'video_create')
+    yield tag_counts_update([([], video['tags'])])
+    videos_changed()
+    raise tornado.gen.Return(result['changes'][0]['new_val'])
 
 
 def videos_get(id):
-    return db.table('videos').get(id).run()
+    return run(db.table('videos').get(id), 'videos_get')
 
 
+@tornado.gen.coroutine
 def video_save(video):
     video_update_scores(video)
-    return (db.table('videos')
+    result = yield run(db.table('videos')
         .get(video['id'])
-        .replace(video, return_changes=True)
-        .run()
-        ['changes'][0]['new_val'])
+        .replace(video, return_changes=True), 'video_save')
+    change = result['changes'][0]
+    yield tag_counts_update([(change['old_val']['tags'], change['new_val']['tags'])])
+    videos_changed()
+    raise tornado.gen.Return(change['new_val'])
 
 
+@tornado.gen.coroutine
 def video_delete(id):
-    result = (db.table('videos')
+    result = yield run(db.table('videos')
         .get(id)
-        .delete()
-        .run())
-    return bool(result['deleted'])
+        .delete(return_changes=True), 'video_delete')
+    yield run(db.table('votes')
+        .get_all(id, index='video_id')
+        .delete(), 'video_delete')
+    yield tag_counts_update([(c['old_val']['tags'], []) for c in result['changes']])
+    videos_changed()
+    raise tornado.gen.Return(bool(result['deleted']))
+
+
+# Ranking functions take the seconds since 2013 a video was created at
+# and its points, either as numbers, as NumPy arrays for rescoring a
+# batch at once or as ReQL terms for scoring inside an update, so they
+# stick to arithmetic and sign().
+def sign(x):
+    if isinstance(x, r.ast.RqlQuery):
+        return r.branch(x.gt(0), 1, x.lt(0), -1, 0)
+    return (x > 0) * 1 - (x < 0) * 1
+
+
+def hot_score(epoch_seconds, points, seconds_per_point=60*60*8):
+    return (points * seconds_per_point + epoch_seconds) / 1000.0 * sign(points)
+
+
+def top_score(epoch_seconds, points):
+    """Orders by points, then by newest, exact up to 900,000 points"""
+    return points * 1e10 + epoch_seconds
+
+
+default_rankings = {
+    'score': hot_score,
+    'top_score': top_score
+}
+
+# The ranking functions in use, see rankings_load
+rankings = dict(default_rankings)
+
+score_epoch = datetime.datetime(2013, 1, 1, tzinfo=utc)
+
+
+def rankings_load(paths):
+    """
+    Uses the ranking functions named in paths, which maps fields to
+    'module.function', in place of the defaults.
+    """
+    functions = dict(default_rankings)
+    for field, path in paths.items():
+        module, name = path.rsplit('.', 1)
+        functions[field] = getattr(importlib.import_module(module), name)
+    rankings.clear()
+    rankings.update(functions)
+
+
+def video_scores_expr(video, points):
+    """Returns ReQL for the ranking fields of video, a row, at points"""
+    epoch_seconds = video['created'].to_epoch_time().sub(
+        unix_time(score_epoch)).floor()
+    return {field: ranking(epoch_seconds, points)
+        for field, ranking in rankings.items()}
 
 
 def video_update_scores(video):
-    def score(created, points, seconds_per_point=60*60*8):
-        td = created - datetime.datetime(2013, 1, 1, tzinfo=utc)
-        epoch_seconds = td.days * 86400 + td.seconds
-        sign = 1 if points > 0 else -1 if points < 0 else 0
-        return (points * seconds_per_point + epoch_seconds) / 1000.0 * sign
-
-    def top_score(created, points):
-        td = created - datetime.datetime(2013, 1, 1, tzinfo=utc)
-        epoch_seconds = td.days * 86400 + td.seconds
-        return float(str(points) + '.' + str(epoch_seconds))
-    
-    video['score'] = score(video['created'], video['points'])
-    video['top_score'] = top_score(video['created'], video['points'])
+    td = video['created'] - score_epoch
+    epoch_seconds = td.days * 86400 + td.seconds
+    for field, ranking in rankings.items():
+        video[field] = float(ranking(epoch_seconds, video['points']))
+
+
+@tornado.gen.coroutine
+def videos_rescore(rankings=rankings, batch_size=1000):
+    """
+    Recomputes the ranking fields of every video, a batch at a time.
+    rankings maps fields to ranking functions.
+    """
+    # Only needed for this maintenance job, not by the web server
+    import numpy
+
+    epoch = (score_epoch - datetime.datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
+    last_id = r.minval
+    n_videos = 0
+    while True:
+        videos = yield run(db.table('videos')
+            .between(last_id, r.maxval, left_bound='open')
+            .order_by(index='id')
+            .limit(batch_size)
+            .map(lambda video: {
+                'id': video['id'],
+                'created': video['created'].to_epoch_time(),
+                'points': video['points']
+            }), 'videos_rescore')
+        if not videos:
+            break
+        epoch_seconds = numpy.floor(
+            numpy.array([v['created'] for v in videos], dtype=float) - epoch)
+        points = numpy.array([v['points'] for v in videos], dtype=float)
+        updates = [{'id': v['id'], 'points': v['points']} for v in videos]
+        for field, ranking in rankings.items():
+            scores = ranking(epoch_seconds, points).tolist()
+            for update, score in zip(updates, scores):
+                update[field] = score
+
+        # Leave videos that were liked since they were read, the like
+        # already wrote scores for the new points
+        yield run(r.expr(updates).for_each(lambda update:
+            db.table('videos').get(update['id']).update(lambda video: r.branch(
+                video['points'].eq(update['points']),
+                update.without('id', 'points'),
+                {}))), 'videos_rescore')
+        n_videos += len(videos)
+        last_id = videos[-1]['id']
+        logging.info('rescored ' + str(n_videos) + ' videos')
+    videos_changed()
+    raise tornado.gen.Return(n_videos)
+
+
+@tornado.gen.coroutine
+def top_scores_migrate():
+    """Converts top_score values from the old points.seconds format"""
+    # The old values are below points + 1, the new ones at least
+    # points * 1e10 plus the seconds since score_epoch
+    epoch = unix_time(score_epoch)
+    result = yield run(db.table('videos')
+        .filter(lambda video: video['top_score'].lt(video['points'].add(1)))
+        .update(lambda video: {'top_score': video['points'].mul(1e10).add(
+            video['created'].to_epoch_time().sub(epoch).floor())}),
+                'top_scores_migrate')
+    if result['replaced']:
+        logging.info('converted top_score of '
+            + str(result['replaced']) + ' videos')
+        videos_changed()
 
 
 def video_suggest_tags(video):
@@ -197,82 +719,330 @@ def video_suggest_tags(video):
             self.suggested_tags.remove(tag)
 
 
-def videos_fetch(tags, sort, page=None, after=None):
-    q = db.table('videos')
-    order = {'hot': 'score', 'top': 'top_score', 'new': 'created'}[sort]
-    q = q.order_by(index=r.desc(order))
+def unix_time(value):
+    return (value - datetime.datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
+
+
+def videos_cursor(video, sort):
+    """
+    Returns an opaque token for the listing position just after video.
+    sort is one of sort_orders or the name of the field a list is in
+    order of.
+    """
+    value = video[sort_orders.get(sort, sort)]
+    if isinstance(value, datetime.datetime):
+        value = unix_time(value)
+    return cursor_encode(sort, value, video['id'])
+
+
+def videos_cursor_key(token, sort):
+    """Returns the [value, id] index key for a videos_cursor token"""
+    value, id = cursor_decode(token, sort)
+    if sort == 'new':
+        value = r.epoch_time(value)
+    return [value, id]
+
+
+@tornado.gen.coroutine
+def videos_fetch(tags, sort, after=None):
+    """
+    Returns a page of 20 videos tagged with all of tags, in sort order.
+    after is a videos_cursor token, the page starts just past it.
+    """
+    if replica.ready:
+        raise tornado.gen.Return(replica.fetch(tags, sort, after))
+    index = sort_orders[sort] + '_id'
+    lower, upper = [r.minval, r.minval], [r.maxval, r.maxval]
+    if after:
+        upper = videos_cursor_key(after, sort)
+    if tags:
+        # Walk the rarest tag's part of the index and check the rest
+        rarest = yield tags_rarest(tags)
+        index = 'tag_' + index
+        lower, upper = [rarest] + lower, [rarest] + upper
+    q = (db.table('videos')
+        .between(lower, upper, index=index, right_bound='open')
+        .order_by(index=r.desc(index)))
     for tag in tags:
-        q = q.filter(r.row['tags'].contains(tag))
-    if page:
-        q = q.skip(page * 20)
-    elif after:
-        q = q.skip(10)
+        if tag != rarest:
+            q = q.filter(r.row['tags'].contains(tag))
     q = q.limit(20)
-    return list(q.run())
-    
+    videos = yield run(q, 'videos_fetch')
+    raise tornado.gen.Return(videos)
     
-def videos_fetch_by_ids(video_ids):
-    contains = None
-    for id in video_ids:
-        c = r.row['video_ids'].contains(id)
-        contains = contains | c if contains else c
     
-    return list(db.table('videos')
-        .filter(contains)
-        .run())
+@tornado.gen.coroutine
+def videos_fetch_dupes(video_ids):
+    """
+    Returns a dictionary mapping the (video_type, id) pairs in video_ids
+    that are already posted to the id of the video they're part of.
+    """
+    if not video_ids:
+        raise tornado.gen.Return({})
+    keys = [[video_type, id] for video_type, id in video_ids]
+    videos = yield run(db.table('videos')
+        .get_all(*keys, index='video_ids')
+        .pluck('id', 'video_type', 'video_ids'), 'videos_fetch_dupes')
+    dupes = {}
+    for video in videos:
+        for id in video['video_ids']:
+            dupes[(video['video_type'], id)] = video['id']
+    raise tornado.gen.Return(dupes)
 
 
+@tornado.gen.coroutine
 def videos_tag_counts(filter_tags=[]):
-    counts = {}
-    q = db.table('videos')
-    for tag in filter_tags:
-        q = q.filter(r.row['tags'].contains(tag))
-    all_tags = (q.map(lambda video: video['tags'])
-        .reduce(lambda left, right: left.add(right))
-        .run())
-    for tag in all_tags:
-        if tag not in filter_tags:
-            counts[tag] = counts.get(tag, 0) + 1
-    return counts
-
-
-def videos_edit_tag(tag, new_tag):
-    return (db.table('videos')
-        .filter(r.row['tags'].contains(tag))
-        .update({
+    """
+    Returns a dictionary mapping tags to the number of videos that have
+    them. With filter_tags, only videos tagged with all of filter_tags
+    are counted and the filter tags themselves are left out.
+    """
+    if replica.ready:
+        raise tornado.gen.Return(replica.tag_counts(filter_tags))
+    if not filter_tags:
+        tags = yield run(db.table('tags').pluck('id', 'count'),
+            'videos_tag_counts')
+        counts = {t['id']: t['count'] for t in tags if t['count'] > 0}
+    elif len(filter_tags) == 1:
+        tag = yield run(db.table('tags').get(filter_tags[0]),
+            'videos_tag_counts')
+        related = tag['related'] if tag else {}
+        counts = {t: n for t, n in related.items() if n > 0}
+    else:
+        # Only the rarest tag's videos need to be read to count the rest
+        rarest = yield tags_rarest(filter_tags)
+        q = db.table('videos').get_all(rarest, index='tags')
+        for tag in filter_tags:
+            if tag != rarest:
+                q = q.filter(r.row['tags'].contains(tag))
+        videos = yield run(q.pluck('tags'), 'videos_tag_counts')
+        counts = {}
+        for video in videos:
+            for tag in video['tags']:
+                if tag not in filter_tags:
+                    counts[tag] = counts.get(tag, 0) + 1
+    raise tornado.gen.Return(counts)
+
+
+@tornado.gen.coroutine
+def videos_edit_tag(tag, new_tag, limit=None):
+    """Renames tag on up to limit of the videos that have it"""
+    q = db.table('videos').get_all(tag, index='tags')
+    if limit:
+        q = q.limit(limit)
+    result = yield run(q.update({
             'tags': r.row['tags'].difference([tag]).append(new_tag).distinct()
-        })
-        .run())
+        }, return_changes=True), 'videos_edit_tag')
+    yield tag_counts_update([(c['old_val']['tags'], c['new_val']['tags'])
+        for c in result['changes']])
+    videos_changed()
+    raise tornado.gen.Return(result)
 
 
-def videos_remove_tag(tag):
-    return (db.table('videos')
-        .filter(r.row['tags'].contains(tag))
-        .update({
+@tornado.gen.coroutine
+def videos_remove_tag(tag, limit=None):
+    """Removes tag from up to limit of the videos that have it"""
+    q = db.table('videos').get_all(tag, index='tags')
+    if limit:
+        q = q.limit(limit)
+    result = yield run(q.update({
             'tags': r.row['tags'].difference([tag]).distinct()
-        })
-        .run())
+        }, return_changes=True), 'videos_remove_tag')
+    yield tag_counts_update([(c['old_val']['tags'], c['new_val']['tags'])
+        for c in result['changes']])
+    videos_changed()
+    raise tornado.gen.Return(result)
+
+
+@tornado.gen.coroutine
+def videos_submitted_by(username, after=None, limit=20):
+    """
+    Returns a page of the videos username submitted, highest scored
+    first. after is a videos_cursor token for the hot sort.
+    """
+    if replica.ready:
+        raise tornado.gen.Return(replica.submitted_by(username, after, limit))
+    upper = [r.maxval, r.maxval]
+    if after:
+        upper = videos_cursor_key(after, 'hot')
+    videos = yield run(db.table('videos')
+        .between([username, r.minval, r.minval], [username] + upper,
+            index='user_score_id', right_bound='open')
+        .order_by(index=r.desc('user_score_id'))
+        .limit(limit), 'videos_submitted_by')
+    raise tornado.gen.Return(videos)
 
 
-def videos_submitted_by(username):
-    return (db.table('videos')
-        .order_by(index=r.desc('score'))
-        .filter({'user_id': username})
-        .run())
+@tornado.gen.coroutine
+def videos_favorites(username, after=None, limit=20):
+    """
+    Returns a page of the videos username liked, most recently liked
+    first, with the time of the like as liked. after is a
+    videos_cursor token for the liked field.
+    """
+    voter = 'user:' + username
+    upper = [r.maxval, r.maxval]
+    if after:
+        value, id = cursor_decode(after, 'liked')
+        upper = [r.epoch_time(value), id]
+    votes = yield run(db.table('votes')
+        .between([voter, r.minval, r.minval], [voter] + upper,
+            index='voter_created', right_bound='open')
+        .order_by(index=r.desc('voter_created'))
+        .limit(limit)
+        .pluck('video_id', 'created'), 'videos_favorites')
+    ids = [vote['video_id'] for vote in votes]
+    if replica.ready:
+        videos = replica.videos(ids)
+    elif ids:
+        videos = yield run(db.table('videos').get_all(*ids),
+            'videos_favorites')
+        videos = {video['id']: video for video in videos}
+        videos = [videos[id] for id in ids if id in videos]
+    else:
+        videos = []
+    liked = {vote['video_id']: vote['created'] for vote in votes}
+    for video in videos:
+        video['liked'] = liked[video['id']]
+    raise tornado.gen.Return(videos)
+
+
+
+### Tags ###
+def tag_count_deltas(changes):
+    """
+    Returns a dictionary mapping tags to their count and co-occurrence
+    deltas for a list of (old_tags, new_tags) pairs.
+    """
+    deltas = {}
+    for old_tags, new_tags in changes:
+        old_tags, new_tags = set(old_tags), set(new_tags)
+        if old_tags == new_tags:
+            continue
+        for tags, n in ((old_tags, -1), (new_tags, 1)):
+            for tag in tags:
+                delta = deltas.setdefault(tag,
+                    {'id': tag, 'count': 0, 'related': {}})
+                delta['count'] += n
+                for other in tags:
+                    if other != tag:
+                        delta['related'][other] = delta['related'].get(other, 0) + n
+    return deltas
 
 
-def videos_favorites(username):
-    return (db.table('videos')
-        .order_by(index=r.desc('score'))
-        .filter(r.row['user_likes'].contains(username))
-        .run())
+@tornado.gen.coroutine
+def tags_rarest(tags):
+    """Returns the tag in tags with the fewest videos"""
+    if len(tags) == 1:
+        raise tornado.gen.Return(tags[0])
+    counts = yield run(db.table('tags')
+        .get_all(*tags)
+        .pluck('id', 'count'), 'tags_rarest')
+    counts = {t['id']: t['count'] for t in counts}
+    raise tornado.gen.Return(min(tags, key=lambda t: counts.get(t, 0)))
+
+
+@tornado.gen.coroutine
+def tag_counts_update(changes):
+    """Applies tag changes to the tags table with atomic increments"""
+    deltas = tag_count_deltas(changes)
+    if not deltas:
+        return
+    yield run(r.expr(list(deltas.values())).for_each(lambda delta:
+        db.table('tags').get(delta['id']).replace(lambda tag: r.branch(
+            tag.eq(None),
+            delta,
+            tag.merge({
+                'count': tag['count'].add(delta['count']),
+                'related': delta['related'].keys().map(lambda other: [
+                    other,
+                    tag['related'][other].default(0).add(delta['related'][other])
+                ]).coerce_to('object')
+            })))), 'tag_counts_update')
+
+
+@tornado.gen.coroutine
+def tag_counts_rebuild():
+    """Recounts every tag from the videos table"""
+    videos = yield run(db.table('videos').pluck('tags'), 'tag_counts_rebuild')
+    tags = list(tag_count_deltas([([], v['tags']) for v in videos]).values())
+    if tags:
+        yield run(db.table('tags').insert(tags, conflict='replace'),
+            'tag_counts_rebuild')
+    yield run(db.table('tags')
+        .filter(lambda tag: r.expr([t['id'] for t in tags]).contains(tag['id']).not_())
+        .delete(), 'tag_counts_rebuild')
+
+
+
+### Votes ###
+def vote_doc(video_id, voter):
+    return {
+        'id': [video_id, voter],
+        'video_id': video_id,
+        'voter': voter,
+        'created': datetime.datetime.now(utc)
+    }
+
+
+@tornado.gen.coroutine
+def video_like(id, ip, user_id=None, force=False):
+    """
+    Records a like from ip and user_id. The video's points are
+    incremented if either of them is a new voter, or always with force.
+
+    Returns the updated video, or None if the like was a repeat.
+    """
+    voters = ['ip:' + ip] + (['user:' + user_id] if user_id else [])
+    # Sent as one query, so stopping half way can't leave a vote without
+    # its point. The vote insert is the only part that can conflict, the
+    # points and the scores for them are written by a single update.
+    result = yield run(db.table('votes')
+        .insert([vote_doc(id, voter) for voter in voters])
+        .do(lambda votes: r.branch(votes['inserted'].gt(0).or_(force),
+            db.table('videos').get(id).update(lambda video: dict(
+                video_scores_expr(video, video['points'].add(1)),
+                points=video['points'].add(1)), return_changes=True),
+            None)), 'video_like')
+    if result is None:
+        raise tornado.gen.Return(None)
+    video = result['changes'][0]['new_val']
+    videos_changed()
+    raise tornado.gen.Return(video)
+
+
+@tornado.gen.coroutine
+def video_liked(id, ip):
+    vote = yield run(db.table('votes').get([id, 'ip:' + ip]), 'video_liked')
+    raise tornado.gen.Return(vote is not None)
+
+
+@tornado.gen.coroutine
+def votes_migrate():
+    """Moves likes stored on video documents into the votes table"""
+    videos = yield run(db.table('videos')
+        .has_fields('ip_likes')
+        .pluck('id', 'ip_likes', 'user_likes'), 'votes_migrate')
+    for video in videos:
+        votes = [vote_doc(video['id'], 'ip:' + ip)
+            for ip in video['ip_likes']]
+        votes += [vote_doc(video['id'], 'user:' + user_id)
+            for user_id in video.get('user_likes', [])]
+        if votes:
+            yield run(db.table('votes')
+                .insert(votes, conflict='replace'), 'votes_migrate')
+    yield run(db.table('videos')
+        .has_fields('ip_likes')
+        .replace(r.row.without('ip_likes', 'user_likes')), 'votes_migrate')
 
 
 
 ### Comments ###
+@tornado.gen.coroutine
 def comment_create(video, user, text, reply_to=None):
     if reply_to:
-        reply_to = db.table('comments').get(reply_to).run()
+        reply_to = yield run(db.table('comments').get(reply_to),
+            'comment_create')
 
     comment = {
         'created': datetime.datetime.now(utc),
@@ -282,16 +1052,17 @@ def comment_create(video, user, text, reply_to=None):
         'points': 1,
         'text': text
     }
-    return (db.table('comments')
-        .insert(comment)
-        .run())
+    result = yield run(db.table('comments')
+        .insert(comment), 'comment_create')
+    videos_changed()
+    raise tornado.gen.Return(result)
 
 
 def comments_for_video(video_id):
-    return (db.table('comments')
-        .order_by('created')
-        .filter(r.row['video_id'] == video_id)
-        .run())
+    return run(db.table('comments')
+        .between([video_id, r.minval], [video_id, r.maxval],
+            index='video_id_created')
+        .order_by(index='video_id_created'), 'comments_for_video')
 
 
 
@@ -304,89 +1075,542 @@ def feed_create(id, url):
         'url': url,
         'active': True
     }
-    return (db.table('feeds')
-        .insert(feed)
-        .run())
+    return run(db.table('feeds')
+        .insert(feed), 'feed_create')
         
 
 def feed_get(id):
-    return db.table('feeds').get(id).run()
+    return run(db.table('feeds').get(id), 'feed_get')
 
 
+@tornado.gen.coroutine
 def feed_replace(id, feed):
-    (db.table('feeds')
+    yield run(db.table('feeds')
         .get(id)
-        .delete()
-        .run())
-    return (db.table('feeds')
-        .insert(feed, return_changes=True)
-        .run()
-        ['changes'][0]['new_val'])
+        .delete(), 'feed_replace')
+    result = yield run(db.table('feeds')
+        .insert(feed, return_changes=True), 'feed_replace')
+    raise tornado.gen.Return(result['changes'][0]['new_val'])
 
 
 def feed_update(id):
-    return (db.table('feeds')
+    return run(db.table('feeds')
         .get(id)
         .update({
             'updated': datetime.datetime.now(utc),
             'next_update': datetime.datetime.now(utc) + datetime.timedelta(hours=12)
-        })
-        .run())
+        }), 'feed_update')
 
 
+@tornado.gen.coroutine
 def feed_delete(id):
-    result = (db.table('feeds')
+    result = yield run(db.table('feeds')
         .get(id)
-        .delete()
-        .run())
-    return bool(result['deleted'])
+        .delete(), 'feed_delete')
+    raise tornado.gen.Return(bool(result['deleted']))
 
 
 def feeds_fetch():
-    return list(db.table('feeds').run())
+    return run(db.table('feeds'), 'feeds_fetch')
+
+
+def feeds_due(limit):
+    """Returns up to limit feeds past their next_update, most overdue first"""
+    return run(db.table('feeds')
+        .between(r.minval, datetime.datetime.now(utc), index='next_update')
+        .order_by(index='next_update')
+        .limit(limit), 'feeds_due')
 
 
 @tornado.gen.coroutine
-def feeds_update(n=1):
-    logging.info('updating feeds')
+def feeds_next_update():
+    """Returns the earliest next_update of any feed"""
+    feeds = yield run(db.table('feeds')
+        .order_by(index='next_update')
+        .limit(1)
+        .pluck('next_update'), 'feeds_next_update')
+    raise tornado.gen.Return(feeds[0]['next_update'] if feeds else None)
 
-    feeds = list(db.table('feeds')
-        .filter(r.row['next_update'] < datetime.datetime.now(utc))
-        .limit(n)
-        .run())
-        
-    requests = {f['id']: utils.video_ids_from_page(f['url']) for f in feeds}
-    responses = yield requests
-    
-    for feed_id, video_ids in responses.items():
-        dupe_videos = videos_fetch_by_ids([id[1] for id in video_ids])
-        dupes = []
-        for video in dupe_videos:
-            dupes += video['video_ids']
-        
-        video_ids = [id for id in video_ids if id[1] not in dupes]
+
+# Feeds are fetched concurrently but videos are created one feed at a
+# time, so two feeds sharing a new video can't both post it.
+feed_ingest_lock = tornado.locks.Lock()
+
+
+@tornado.gen.coroutine
+def feed_crawl(feed, wait_for_host=None):
+    """Creates a video for every new YouTube or Vimeo video on a feed"""
+    try:
+        if wait_for_host:
+            yield wait_for_host(feed['url'])
+        video_ids = yield utils.video_ids_from_page(feed['url'])
+        dupes = yield videos_fetch_dupes(video_ids)
+        video_ids = [id for id in video_ids if tuple(id) not in dupes]
         youtube_ids = [id for vid_type, id in video_ids if vid_type == 'youtube']
         vimeo_ids = [id for vid_type, id in video_ids if vid_type == 'vimeo']
 
+        video_data = []
         if youtube_ids:
-            video_data = yield utils.youtube_data_async(youtube_ids)
-        elif vimeo_ids:
-            video_data = yield utils.vimeo_data_async(vimeo_ids)
-        else:
-            video_data = None
-        
-        if video_data:
-            datum = video_data[0]
-            video = video_create(
-                feed=feed_id,
-                points=0,
-                title=datum['title'],
-                thumbnail=datum['thumbnail'],
-                text=datum['description'],
-                video_ids=[datum['id']],
-                video_type=datum['video_type'])
-        
-        feed_update(feed_id)
-        logging.info('updated feed: ' + feed_id)
+            video_data += yield utils.youtube_data_async(youtube_ids)
+        if vimeo_ids:
+            video_data += yield utils.vimeo_data_async(vimeo_ids)
+
+        with (yield feed_ingest_lock.acquire()):
+            dupes = yield videos_fetch_dupes(
+                [(d['video_type'], d['id']) for d in video_data])
+            for datum in video_data:
+                if (datum['video_type'], datum['id']) in dupes:
+                    continue
+                yield video_create(
+                    feed=feed['id'],
+                    points=0,
+                    title=datum['title'],
+                    thumbnail=datum['thumbnail'],
+                    text=datum['description'],
+                    video_ids=[datum['id']],
+                    video_type=datum['video_type'])
+        logging.info('updated feed: ' + feed['id'] +
+            ' (' + str(len(video_data)) + ' new videos)')
+    except Exception:
+        logging.exception('failed to update feed: ' + feed['id'])
+    yield feed_update(feed['id'])
+
+
+# Feeds are only crawled by the holder of this lease, so cron and a
+# server's FeedCrawler never crawl the same feed at once. Holders renew
+# it while they crawl and it runs out if they stop.
+crawler_lease_seconds = 180
+
+
+@tornado.gen.coroutine
+def crawler_lease_take(owner):
+    """Takes or renews the crawler lease, returns whether owner holds it"""
+    lease = {
+        'id': 'crawler_lease',
+        'owner': owner,
+        'expires': r.now().add(crawler_lease_seconds)
+    }
+    result = yield run(db.table('settings')
+        .get('crawler_lease')
+        .replace(lambda old: r.branch(
+            old.eq(None).or_(old['owner'].eq(owner))
+                .or_(old['expires'].lt(r.now())),
+            lease,
+            old), return_changes='always'), 'crawler_lease_take')
+    raise tornado.gen.Return(result['changes'][0]['new_val']['owner'] == owner)
+
+
+def crawler_lease_release(owner):
+    return run(db.table('settings')
+        .get_all('crawler_lease')
+        .filter({'owner': owner})
+        .delete(), 'crawler_lease_release')
+
+
+@tornado.gen.coroutine
+def feeds_update(n=1):
+    """Crawls up to n due feeds, returns False if a server is crawling"""
+    owner = str(uuid.uuid4())
+    if not (yield crawler_lease_take(owner)):
+        logging.error('feeds are being crawled by a server, not updating')
+        raise tornado.gen.Return(False)
+    try:
+        logging.info('updating feeds')
+        feeds = yield feeds_due(n)
+        yield [feed_crawl(feed) for feed in feeds]
+    finally:
+        yield crawler_lease_release(owner)
+    raise tornado.gen.Return(True)
+
+
+class FeedCrawler(object):
+    """
+    Keeps feeds up to date from inside a long running IOLoop.
+
+    Due feeds are taken in next_update order and crawled with at most
+    concurrency running at once and at most one page request per host
+    every host_delay seconds. Between batches the crawler sleeps until
+    the next feed is due or a crawl finishes, checking at least every
+    poll_interval seconds for feeds that were added or edited. It only
+    crawls while it holds the crawler lease.
+    """
+    def __init__(self, concurrency=4, host_delay=2, poll_interval=60):
+        self.concurrency = concurrency
+        self.host_delay = host_delay
+        self.poll_interval = poll_interval
+        self.owner = str(uuid.uuid4())
+        self._slots = tornado.locks.Semaphore(concurrency)
+        self._crawling = set()
+        self._crawled = tornado.locks.Condition()
+        self._host_locks = {}
+        self._host_times = {}
+
+    @tornado.gen.coroutine
+    def run(self):
+        while True:
+            next_update = None
+            try:
+                if (yield crawler_lease_take(self.owner)):
+                    yield self._crawl_due()
+                    next_update = yield feeds_next_update()
+            except Exception:
+                logging.exception('feed crawler failed')
+            wait = self.poll_interval
+            if next_update:
+                until = (next_update - datetime.datetime.now(utc)).total_seconds()
+                # A feed that's due while crawls are running is most
+                # likely one of them, its next_update moves when it's done
+                if until > 0 or not self._crawling:
+                    wait = max(0, min(wait, until))
+            yield self._crawled.wait(datetime.timedelta(seconds=wait))
+
+    @tornado.gen.coroutine
+    def _crawl_due(self):
+        feeds = yield feeds_due(self.concurrency * 4)
+        for feed in feeds:
+            if feed['id'] in self._crawling:
+                continue
+            yield self._slots.acquire()
+            self._crawling.add(feed['id'])
+            tornado.ioloop.IOLoop.current().spawn_callback(self._crawl, feed)
+
+    @tornado.gen.coroutine
+    def _crawl(self, feed):
+        try:
+            yield feed_crawl(feed, wait_for_host=self._wait_for_host)
+        finally:
+            self._crawling.discard(feed['id'])
+            self._slots.release()
+            self._crawled.notify_all()
+
+    @tornado.gen.coroutine
+    def _wait_for_host(self, url):
+        host = url.split('://', 1)[-1].split('/', 1)[0]
+        lock = self._host_locks.setdefault(host, tornado.locks.Lock())
+        with (yield lock.acquire()):
+            wait = self._host_times.get(host, 0) + self.host_delay - time.time()
+            if wait > 0:
+                yield tornado.gen.sleep(wait)
+            self._host_times[host] = time.time()
+
+
+
+### Jobs ###
+@tornado.gen.coroutine
+def job_create(type, args, total=None):
+    """Queues a job_types job, total is the amount of work for progress"""
+    now = datetime.datetime.now(utc)
+    result = yield run(db.table('jobs')
+        .insert({
+            'type': type,
+            'args': args,
+            'status': 'queued',
+            'created': now,
+            'updated': now,
+            'done': 0,
+            'total': total,
+            'error': None
+        }, return_changes=True), 'job_create')
+    raise tornado.gen.Return(result['changes'][0]['new_val'])
+
+
+def job_update(id, fields):
+    fields = dict(fields, updated=datetime.datetime.now(utc))
+    return run(db.table('jobs').get(id).update(fields), 'job_update')
+
+
+def jobs_fetch(limit=10):
+    """Returns the most recent jobs"""
+    return run(db.table('jobs')
+        .order_by(index=r.desc('created'))
+        .limit(limit), 'jobs_fetch')
+
+
+@tornado.gen.coroutine
+def jobs_next():
+    """Returns the oldest unfinished job, jobs that were running first"""
+    for status in ('running', 'queued'):
+        jobs = yield run(db.table('jobs')
+            .get_all(status, index='status')
+            .order_by('created')
+            .limit(1), 'jobs_next')
+        if jobs:
+            raise tornado.gen.Return(jobs[0])
+
+
+# Each step does up to batch_size of a job's work and returns how much
+# it did, the job is finished when a step does nothing. Steps work out
+# what's left from the data, so a job can resume after a restart.
+@tornado.gen.coroutine
+def job_edit_tag(args, batch_size):
+    if args['tag'] == args['new_tag']:
+        raise tornado.gen.Return(0)
+    result = yield videos_edit_tag(args['tag'], args['new_tag'], limit=batch_size)
+    raise tornado.gen.Return(result['replaced'])
 
 
+@tornado.gen.coroutine
+def job_remove_tag(args, batch_size):
+    result = yield videos_remove_tag(args['tag'], limit=batch_size)
+    raise tornado.gen.Return(result['replaced'])
+
+
+job_types = {
+    'edit_tag': job_edit_tag,
+    'remove_tag': job_remove_tag
+}
+
+
+class JobRunner(object):
+    """
+    Works through queued jobs one at a time, oldest first.
+
+    Each job runs in steps of batch_size with batch_delay seconds in
+    between, so bulk writes don't crowd out the site's own queries.
+    Progress is saved after every step. Between jobs the runner checks
+    for new ones every poll_interval seconds.
+    """
+    def __init__(self, batch_size=100, batch_delay=1, poll_interval=5):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.poll_interval = poll_interval
+
+    @tornado.gen.coroutine
+    def run(self):
+        while True:
+            try:
+                job = yield jobs_next()
+                if job:
+                    yield self._run_job(job)
+                    continue
+            except Exception:
+                logging.exception('job runner failed')
+            yield tornado.gen.sleep(self.poll_interval)
+
+    @tornado.gen.coroutine
+    def _run_job(self, job):
+        logging.info('running job ' + job['type'] + ' ' + json.dumps(job['args']))
+        yield job_update(job['id'], {'status': 'running'})
+        try:
+            step = job_types[job['type']]
+            done = job['done']
+            while True:
+                n = yield step(job['args'], self.batch_size)
+                if not n:
+                    break
+                done += n
+                yield job_update(job['id'], {'done': done})
+                yield tornado.gen.sleep(self.batch_delay)
+        except Exception as e:
+            logging.exception('job failed: ' + job['id'])
+            yield job_update(job['id'], {'status': 'failed', 'error': str(e)})
+        else:
+            yield job_update(job['id'], {'status': 'done'})
+
+
+
+### Replica ###
+class VideoRecord(object):
+    """The listing_fields of a video"""
+    __slots__ = listing_fields
+
+    def __init__(self, video):
+        for field in self.__slots__:
+            setattr(self, field, video.get(field))
+        self.tags = tuple(self.tags or ())
+
+    def key(self, sort):
+        """Returns the (value, id) position of the record in sort order"""
+        value = getattr(self, sort_orders[sort])
+        if isinstance(value, datetime.datetime):
+            value = unix_time(value)
+        return (value, self.id)
+
+    def as_dict(self):
+        video = {field: getattr(self, field) for field in self.__slots__}
+        video['tags'] = list(self.tags)
+        return video
+
+
+class VideoReplica(object):
+    """
+    An in-memory copy of the listing fields of the videos table.
+
+    It is filled and kept up to date by a changefeed and answers the
+    listing queries of the videos_ functions while ready is set. Each
+    sort order, overall and per tag, is kept as an ascending list of
+    (value, id) keys. When the changefeed drops the replica is emptied
+    and loaded again, and the database answers in the meantime.
+
+    Changes show up in the replica shortly after the write that made
+    them, not as part of it, so videos_version is bumped again as each
+    one is applied.
+    """
+    def __init__(self, retry_delay=5):
+        self.retry_delay = retry_delay
+        self.ready = False
+        self._clear()
+
+    def _clear(self):
+        self._records = {}
+        self._orders = {sort: [] for sort in sort_orders}
+        self._tagged = {}
+        self._submitted = {}
+
+    @tornado.gen.coroutine
+    def run(self):
+        while True:
+            conn = None
+            try:
+                # The changefeed holds on to its connection, so it gets
+                # its own instead of one from the pool
+                conn = yield r.connect(pool.host, pool.port)
+                feed = yield (db.table('videos')
+                    .pluck(*VideoRecord.__slots__)
+                    .changes(include_initial=True, include_states=True)
+                    .run(conn))
+                while (yield feed.fetch_next()):
+                    change = yield feed.next()
+                    if 'state' not in change:
+                        if self.ready:
+                            self._apply(change)
+                        else:
+                            self._load(change)
+                    elif change['state'] == 'ready':
+                        self._build()
+                        logging.info('video replica loaded '
+                            + str(len(self._records)) + ' videos')
+                        self.ready = True
+            except Exception:
+                logging.exception('video replica changefeed failed')
+            finally:
+                self.ready = False
+                self._clear()
+                if conn:
+                    conn.close(noreply_wait=False)
+            yield tornado.gen.sleep(self.retry_delay)
+
+    def _load(self, change):
+        # Until the initial load is done only the records are kept, the
+        # orders are built from them in one go by _build
+        if change.get('old_val'):
+            self._records.pop(change['old_val']['id'], None)
+        if change.get('new_val'):
+            record = VideoRecord(change['new_val'])
+            self._records[record.id] = record
+
+    def _build(self):
+        for record in self._records.values():
+            for sort, keys in self._orders.items():
+                key = record.key(sort)
+                keys.append(key)
+                for tag in record.tags:
+                    orders = self._tagged.setdefault(tag,
+                        {sort: [] for sort in sort_orders})
+                    orders[sort].append(key)
+            if record.user_id:
+                self._submitted.setdefault(record.user_id, set()).add(record.id)
+        for keys in self._orders.values():
+            keys.sort()
+        for orders in self._tagged.values():
+            for keys in orders.values():
+                keys.sort()
+        videos_changed()
+
+    def _apply(self, change):
+        if change.get('old_val'):
+            self._remove(change['old_val']['id'])
+        if change.get('new_val'):
+            self._add(VideoRecord(change['new_val']))
+        videos_changed()
+
+    def _add(self, record):
+        self._remove(record.id)
+        self._records[record.id] = record
+        for sort, keys in self._orders.items():
+            key = record.key(sort)
+            bisect.insort(keys, key)
+            for tag in record.tags:
+                orders = self._tagged.setdefault(tag,
+                    {sort: [] for sort in sort_orders})
+                bisect.insort(orders[sort], key)
+        if record.user_id:
+            self._submitted.setdefault(record.user_id, set()).add(record.id)
+
+    def _remove(self, id):
+        record = self._records.pop(id, None)
+        if not record:
+            return
+        for sort in sort_orders:
+            key = record.key(sort)
+            self._remove_key(self._orders[sort], key)
+            for tag in record.tags:
+                self._remove_key(self._tagged[tag][sort], key)
+        for tag in record.tags:
+            if tag in self._tagged and not self._tagged[tag]['new']:
+                del self._tagged[tag]
+        if record.user_id:
+            self._submitted[record.user_id].discard(id)
+            if not self._submitted[record.user_id]:
+                del self._submitted[record.user_id]
+
+    @staticmethod
+    def _remove_key(keys, key):
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    def _count(self, tag):
+        return len(self._tagged[tag]['new']) if tag in self._tagged else 0
+
+    def fetch(self, tags, sort, after=None):
+        """Answers videos_fetch"""
+        keys = self._orders[sort]
+        if tags:
+            rarest = min(tags, key=self._count)
+            keys = self._tagged[rarest][sort] if rarest in self._tagged else []
+        end = len(keys)
+        if after:
+            end = bisect.bisect_left(keys, cursor_decode(after, sort))
+        videos = []
+        # Walk down from just below the cursor, newest or highest first
+        for value, id in itertools.islice(reversed(keys), len(keys) - end, None):
+            record = self._records[id]
+            if not all(tag in record.tags for tag in tags):
+                continue
+            videos.append(record.as_dict())
+            if len(videos) == 20:
+                break
+        return videos
+
+    def tag_counts(self, filter_tags=[]):
+        """Answers videos_tag_counts"""
+        if not filter_tags:
+            return {tag: self._count(tag) for tag in self._tagged}
+        rarest = min(filter_tags, key=self._count)
+        keys = self._tagged[rarest]['new'] if rarest in self._tagged else []
+        counts = {}
+        for value, id in keys:
+            record = self._records[id]
+            if not all(tag in record.tags for tag in filter_tags):
+                continue
+            for tag in record.tags:
+                if tag not in filter_tags:
+                    counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+    def videos(self, ids):
+        """Returns the videos with ids that exist, in the order of ids"""
+        return [self._records[id].as_dict() for id in ids if id in self._records]
+
+    def submitted_by(self, username, after=None, limit=20):
+        """Answers videos_submitted_by"""
+        keys = sorted(self._records[id].key('hot')
+            for id in self._submitted.get(username, ()))
+        if after:
+            keys = keys[:bisect.bisect_left(keys,
+                cursor_decode(after, 'hot'))]
+        return self.videos([id for value, id in reversed(keys[-limit:])])
+
+
+replica = VideoReplica()
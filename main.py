@@ -1,14 +1,22 @@
 import datetime
+import errno
+import hmac
 import json
 import logging
+import mimetypes
 import os
 import re
+import signal
 import subprocess
 import sys
+import time
 import urllib
 
 import tornado.escape
 import tornado.gen
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.ioloop
 
@@ -16,22 +24,83 @@ import utils
 import db
 
 
-settings = db.settings_get()
-utils.youtube_api_key = settings['youtube_api_key']
+settings = {}
+
+# Requests being handled, so a shutdown can wait for them
+requests_active = 0
+
+# Pages rendered for logged out visitors. A page is served as is for
+# page_cache_fresh seconds and until the videos change. After that one
+# request re-renders it while the others keep getting the stale copy.
+page_cache = utils.LRUCache(max_size=500, ttl=600)
+page_cache_fresh = 60
 
 
 class BaseHandler(tornado.web.RequestHandler):
-    def get_current_user(self):
+    _page_cache_key = None
+
+    def initialize(self):
+        global requests_active
+        requests_active += 1
+
+    def on_finish(self):
+        global requests_active
+        requests_active -= 1
+        utils.metrics.observe('handler_seconds', self.request.request_time(),
+            handler=type(self).__name__, method=self.request.method)
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        """Loads the current user and tag counts before the handler runs"""
         user_id = self.get_secure_cookie('user')
-        if user_id:
-            return db.user_get(user_id)
+        self.current_user = (yield db.user_get(user_id)) if user_id else None
+        if (self.request.method == 'GET' and not self.current_user
+            and not self.get_cookie('message')):
+            self._page_cache_key = yield self.page_cache_key()
+            self._page_cache_version = db.videos_version
+            if self._page_cache_key and self.write_cached_page():
+                return
+        self._tag_counts = yield db.videos_tag_counts()
 
     def get_tag_counts(self):
-        # TODO: cache tags in db module
-        if not hasattr(self, 'tag_counts'):
-            self._tag_counts = db.videos_tag_counts()
         return self._tag_counts
 
+    @tornado.gen.coroutine
+    def page_cache_key(self):
+        """Returns a key to cache this page under for logged out users"""
+        raise tornado.gen.Return(None)
+
+    def write_cached_page(self):
+        page = page_cache.get(self._page_cache_key)
+        if page is None:
+            return False
+        now = time.time()
+        stale = (page['version'] != db.videos_version or
+            page['created'] + page_cache_fresh < now)
+        if stale and page['refreshing'] + 10 < now:
+            page['refreshing'] = now
+            return False
+        # Swap in this visitor's xsrf token for the one rendered in
+        self.finish(page['html'].replace(page['xsrf'], self.xsrf_token))
+        return True
+
+    def render(self, template_name, **kwargs):
+        if not self._page_cache_key:
+            return super(BaseHandler, self).render(template_name, **kwargs)
+        html = self.render_string(template_name, **kwargs)
+        page_cache.set(self._page_cache_key, {
+            'html': html,
+            'xsrf': self.xsrf_token,
+            'version': self._page_cache_version,
+            'created': time.time(),
+            'refreshing': 0
+        })
+        self.finish(html)
+
+    def render_string(self, template_name, **kwargs):
+        with utils.metrics.timer('template_seconds', template=template_name):
+            return super(BaseHandler, self).render_string(template_name, **kwargs)
+
     def get_template_namespace(self):
         """Template globals"""
         namespace = super(BaseHandler, self).get_template_namespace()
@@ -146,15 +215,31 @@ class BaseHandler(tornado.web.RequestHandler):
 
 
 class Index(BaseHandler):
+    # Old ?page= links are only followed this deep
+    legacy_pages = 5
+
+    @tornado.gen.coroutine
+    def page_cache_key(self):
+        raise tornado.gen.Return(('index', self.request.path,
+            self.get_argument('sort', None),
+            self.get_argument('after', None)))
+
+    @tornado.gen.coroutine
     def get(self, tag_slug=None):
         sort = self.get_argument('sort', None)
         sort = sort if sort in ('new', 'top') else 'hot'
         tags = self.parse_tag_slug(tag_slug)
-        page = self.get_argument('page', '')
-        page = int(page) if page.isdigit() else 0
-        videos = db.videos_fetch(tags, sort, page)
-        next_page = page + 1 if len(videos) == 20 else None
-        filter_tags = db.videos_tag_counts(tags).items() if tags else []
+        page = self.get_argument('page', None)
+        if page is not None:
+            yield self.redirect_page(tags, sort, page)
+            return
+        after = self.get_argument('after', None)
+        try:
+            videos = yield db.videos_fetch(tags, sort, after)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        next_page = db.videos_cursor(videos[-1], sort) if len(videos) == 20 else None
+        filter_tags = (yield db.videos_tag_counts(tags)).items() if tags else []
         filter_tags.sort(key=lambda x: x[0])
         filter_tags_top = sorted(filter_tags, key=lambda x: x[1], reverse=True)[:3]
         
@@ -165,9 +250,27 @@ class Index(BaseHandler):
             filter_tags=filter_tags,
             filter_tags_top=filter_tags_top,
             videos=videos,
-            page=page,
             next_page=next_page)
 
+    @tornado.gen.coroutine
+    def redirect_page(self, tags, sort, page):
+        """
+        Sends an old ?page= link to the after= link for the same spot,
+        walking at most legacy_pages pages to find it.
+        """
+        page = int(page) if page.isdigit() else 0
+        if page > self.legacy_pages:
+            raise tornado.web.HTTPError(404)
+        after = None
+        for i in range(page):
+            videos = yield db.videos_fetch(tags, sort, after)
+            if not videos:
+                break
+            after = db.videos_cursor(videos[-1], sort)
+        self.redirect(self.link(tags=tags, query={
+            'sort': sort if sort != 'hot' else None,
+            'after': after}))
+
     def filter_tags(self, videos, selected_tags):
         total_vids = len(videos)
         if total_vids < 2:
@@ -192,16 +295,19 @@ class SignUp(BaseHandler):
     def get(self):
         self.render('sign_up.html')
 
+    @tornado.gen.coroutine
     def post(self):
         bot = self.get_argument('bot', None)
         username = self.get_argument('username', None)
         password = self.get_argument('password', None)
         if bot or not username or not password:
-            return self.reload(message='Please fill in your username and password.')
+            self.reload(message='Please fill in your username and password.')
+            return
         username = ''.join(c for c in username.lower() if c.isalnum() or c in '-_')[:20]
-        user = db.user_create(username=username, password=password)
+        user = yield db.user_create(username=username, password=password)
         if not user:
-            return self.reload(message='Sorry, that username is already in use.')
+            self.reload(message='Sorry, that username is already in use.')
+            return
         self.set_secure_cookie('user', user['id'])
         self.redirect(self.link())
 
@@ -211,15 +317,21 @@ class Login(SignUp):
     def get(self):
         self.render('login.html')
 
+    @tornado.gen.coroutine
     def post(self):
         username = self.get_argument('username', None)
         password = self.get_argument('password', None)
         next = self.get_argument('next', '/')
         if not username or not password:
-            return self.reload()
-        user = db.user_get(username)
-        if not user or not db.user_check_password(user['password'], password):
-            return self.reload(message='Incorrect Username or Password.')
+            self.reload()
+            return
+        user = yield db.user_get(username, cached=False)
+        if not user or not (yield db.user_check_password(user['password'], password)):
+            self.reload(message='Incorrect Username or Password.')
+            return
+        if db.user_password_outdated(user['password']):
+            user['password'] = yield db.user_hash_password(password)
+            yield db.user_save(user)
         self.set_secure_cookie('user', user['id'])
         self.redirect(next if next.startswith('/') else '/')
 
@@ -231,15 +343,27 @@ class Logout(BaseHandler):
 
 
 class User(BaseHandler):
+    @tornado.gen.coroutine
     def get(self, id):
-        user = db.user_get(id)
+        user = yield db.user_get(id)
         if not user:
             raise tornado.web.HTTPError(404)
+        try:
+            favorites, submitted = yield [
+                db.videos_favorites(id, self.get_argument('favorites_after', None)),
+                db.videos_submitted_by(id, self.get_argument('submitted_after', None))]
+        except ValueError:
+            raise tornado.web.HTTPError(400)
         self.render('user.html', user=user,
-            favorites=db.videos_favorites(id),
-            submitted=db.videos_submitted_by(id))
+            favorites=favorites,
+            submitted=submitted,
+            next_favorites=db.videos_cursor(favorites[-1], 'liked')
+                if len(favorites) == 20 else None,
+            next_submitted=db.videos_cursor(submitted[-1], 'hot')
+                if len(submitted) == 20 else None)
 
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def post(self, id):
         action = self.get_argument('action', None)
         password = self.get_argument('password', None)
@@ -248,35 +372,50 @@ class User(BaseHandler):
             self.current_user['about'] = self.get_argument('about', None)
         elif action == 'settings':
             if password == password_repeat:
-                self.current_user['password'] = db.user_hash_password(password)
-        db.user_save(self.current_user)
+                self.current_user['password'] = yield db.user_hash_password(password)
+        yield db.user_save(self.current_user)
         self.reload()
 
 
 class Tags(BaseHandler):
+    @tornado.gen.coroutine
     def get(self):
-        tag_counts = db.videos_tag_counts()
+        tag_counts = self.get_tag_counts()
         tags = sorted(tag_counts.items(), key=lambda tag: tag[0])
-        self.render('tags.html', tags=tags)
+        jobs = (yield db.jobs_fetch()) if self.authorized('moderate') else []
+        self.render('tags.html', tags=tags, jobs=jobs)
 
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def post(self):
         self.authorize('moderate')
         action = self.get_argument('action', None)
+        # Rewriting every video with a popular tag takes a while, so the
+        # job runner does it in the background
         if action == 'edit_tag':
             tag = self.get_argument('tag')
             new_tag = self.get_argument('new_tag')
             new_tag = self.clean_tag(new_tag)
-            db.videos_edit_tag(tag, new_tag)
+            yield db.job_create('edit_tag', {'tag': tag, 'new_tag': new_tag},
+                total=self.get_tag_counts().get(tag, 0))
         elif action == 'remove_tag':
             tag = self.get_argument('tag')
-            db.videos_remove_tag(tag)
+            yield db.job_create('remove_tag', {'tag': tag},
+                total=self.get_tag_counts().get(tag, 0))
         self.reload()
 
 
 class Video(BaseHandler):
+    @tornado.gen.coroutine
+    def page_cache_key(self):
+        id = int(self.path_kwargs['id'])
+        liked = yield db.video_liked(id, self.request.remote_ip)
+        raise tornado.gen.Return(('video', self.request.path,
+            self.get_argument('sort', None), liked))
+
+    @tornado.gen.coroutine
     def get(self, id, tag_slug=None):
-        video = db.videos_get(int(id))
+        video = yield db.videos_get(int(id))
         if not video:
             raise tornado.web.HTTPError(404)
 
@@ -284,34 +423,60 @@ class Video(BaseHandler):
         sort = sort if sort in ('new', 'top') else 'hot'
         tags = self.parse_tag_slug(tag_slug)
 
-        playlist = db.videos_fetch(tags, sort, after=video['id'])
-        comments = db.comments_for_video(video['id'])
+        playlist, comments, liked = yield [
+            db.videos_fetch(tags, sort, after=db.videos_cursor(video, sort)),
+            db.comments_for_video(video['id']),
+            db.video_liked(video['id'], self.request.remote_ip)]
         self.render('video.html',
             sort=sort,
             selected_tags=tags,
             video=video,
             embed_src=self.embed_src,
             playlist=playlist,
+            next_playlist=db.videos_cursor(playlist[-1], sort)
+                if len(playlist) == 20 else None,
             comments=self.nest_replies(comments),
-            liked=self.request.remote_ip in video['ip_likes'])
+            liked=liked)
 
     @staticmethod
     def nest_replies(comments):
-        """Returns a dictionary mapping comment keys to their replies"""
-        keys = {c['id']: [] for c in comments}
+        """
+        Adds a list of replies to each comment and returns the top level
+        comments. Comments must be in created order, so parents come first.
+        """
+        keys = {}
+        top = []
         for comment in comments:
-            keys[comment['id']] = comment
             comment['replies'] = []
-        for comment in comments:
-            if comment['reply_to']:
-                parent = keys.get(comment['reply_to'])
-                if parent:
-                    parent['replies'].append(comment)
-        return [c for c in comments if not c['reply_to']]
+            keys[comment['id']] = comment
+            if not comment['reply_to']:
+                top.append(comment)
+            elif comment['reply_to'] in keys:
+                keys[comment['reply_to']]['replies'].append(comment)
+        return top
 
-    def render_comments(self, comments, nest=0):
+    @staticmethod
+    def flatten_replies(comments):
+        """
+        Returns (comment, nest, closes) for each comment in the tree in
+        display order, where closes is the number of comment divs to
+        close after it.
+        """
+        items = []
+        stack = [(c, 0) for c in reversed(comments)]
+        while stack:
+            comment, nest = stack.pop()
+            if items:
+                items[-1][2] = items[-1][1] + 1 - nest
+            items.append([comment, nest, 0])
+            stack.extend((c, nest + 1) for c in reversed(comment['replies']))
+        if items:
+            items[-1][2] = items[-1][1] + 1
+        return items
+
+    def render_comments(self, comments):
         return self.render_string('_video_comment.html',
-            comments=comments, nest=nest)
+            comments=self.flatten_replies(comments))
 
     @staticmethod
     def embed_src(id, video_type):
@@ -320,56 +485,51 @@ class Video(BaseHandler):
         elif video_type == 'vimeo':
             return 'http://player.vimeo.com/video/' + str(id)
 
+    @tornado.gen.coroutine
     def post(self, id, tag_slug=None):
-        video = db.videos_get(int(id))
+        video = yield db.videos_get(int(id))
         if not video:
             raise tornado.web.HTTPError(404)
 
         action = self.get_argument('action', None)
         if action == 'like':
-            user_can_vote = (self.current_user and 
-                self.current_user['id'] not in video['user_likes'])
-            anon_can_vote = (self.request.remote_ip not in video['ip_likes'])
-            mod_can_vote = (self.current_user and 
-                self.current_user['id'] in ('csytan', 'sloepink'))
-            if user_can_vote or mod_can_vote or anon_can_vote:
-                if self.current_user:
-                    video['user_likes'].append(self.current_user['id'])
-                    video['user_likes'] = list(set(video['user_likes']))
-                video['ip_likes'].append(self.request.remote_ip)
-                video['ip_likes'] = list(set(video['ip_likes']))
-                video['points'] += 1
-                db.video_save(video)
-                if self.current_user and video['user_id'] and video['points'] < 10:
-                    db.user_add_karma(video['user_id'])
-            return self.write('1')
+            user_id = self.current_user['id'] if self.current_user else None
+            mod_can_vote = user_id in ('csytan', 'sloepink')
+            video = yield db.video_like(video['id'], self.request.remote_ip,
+                user_id, force=mod_can_vote)
+            if video and self.current_user and video['user_id'] and video['points'] < 10:
+                yield db.user_add_karma(video['user_id'])
+            self.write('1')
+            return
         elif action == 'flag':
             self.authorize('moderate')
             video['n_likes'] -= 1
-            db.video_save(video)
-            return self.write('1')
+            yield db.video_save(video)
+            self.write('1')
+            return
         elif action == 'edit_tags':
             tags = self.get_argument('tags', '')
             tags = [self.clean_tag(t) for t in tags.split('|')]
             tags = list(set(t for t in tags if t))
             video['tags'] = tags
-            db.video_save(video)
+            yield db.video_save(video)
         elif action == 'comment':
             self.authorize('comment')
             reply_to = self.get_argument('reply_to', None)
             text = self.get_argument('text', None)
             if text:
-                db.comment_create(video, self.current_user, text, reply_to)
+                yield db.comment_create(video, self.current_user, text, reply_to)
                 video['n_comments'] += 1
-                db.video_save(video)
+                yield db.video_save(video)
         self.reload()
 
 
 class AddOrEditVideo(BaseHandler):
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def get(self, id=None, tag_slug=None):
         if id:
-            video = db.videos_get(int(id))
+            video = yield db.videos_get(int(id))
             if not video:
                 raise tornado.web.HTTPError(404)
         else:
@@ -385,7 +545,7 @@ class AddOrEditVideo(BaseHandler):
         text = self.get_argument('text', '')
 
         if action == 'remove':
-            video = db.video_delete(int(id))
+            video = yield db.video_delete(int(id))
             if not video:
                 raise tornado.web.HTTPError(404)
             self.set_secure_cookie('message', 'Video removed.')
@@ -428,45 +588,97 @@ class AddOrEditVideo(BaseHandler):
         }
 
         if id:
-            video = db.videos_get(int(id))
+            video = yield db.videos_get(int(id))
             if not video:
                 raise tornado.web.HTTPError(404)
             video.update(params)
-            db.video_save(video)
+            yield db.video_save(video)
         else:
-            dupes = db.videos_fetch_by_ids(video_ids)
+            dupes = yield db.videos_fetch_dupes(
+                [(video_type, vid_id) for vid_id in video_ids])
             if dupes:
-                self.redirect(self.link(vid_id=dupes[0]['id']))
+                self.redirect(self.link(vid_id=list(dupes.values())[0]))
                 return
-            video = db.video_create(
+            video = yield db.video_create(
                 user_id=self.current_user['id'],
                 ip_likes=[self.request.remote_ip],
                 **params)
-            db.user_add_karma(1)
+            yield db.user_add_karma(self.current_user['id'])
         self.redirect(self.link(vid_id=video['id']))
 
 
+class VideosApi(BaseHandler):
+    """
+    A page of a listing as JSON, for loading more videos in place.
+    Takes the sort, after and tag arguments of Index, tag repeated.
+    """
+    def prepare(self):
+        # Listings don't need the user or the tag counts
+        pass
+
+    def compute_etag(self):
+        # compress_response may gzip the body this is computed from, so
+        # the ETag is weak and the response varies on Accept-Encoding
+        etag = super(VideosApi, self).compute_etag()
+        return 'W/' + etag if etag else etag
+
+    @tornado.gen.coroutine
+    def get(self):
+        sort = self.get_argument('sort', None)
+        sort = sort if sort in ('new', 'top') else 'hot'
+        tags = self.get_arguments('tag')
+        try:
+            videos = yield db.videos_fetch(tags, sort,
+                after=self.get_argument('after', None))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        items = []
+        for video in videos:
+            item = {field: video.get(field) for field in db.listing_fields
+                if field not in ('score', 'top_score')}
+            item['created'] = db.unix_time(video['created'])
+            item['url'] = self.link(tags=tags, vid_id=video['id'],
+                query={'sort': sort if sort != 'hot' else None})
+            items.append(item)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        # Browsers check back every time, finish() answers the request's
+        # If-None-Match with a 304 when the ETag of the body matches
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps({
+            'videos': items,
+            'next': db.videos_cursor(videos[-1], sort) if len(videos) == 20 else None
+        }, sort_keys=True, separators=(',', ':')))
+
+
 class About(BaseHandler):
+    @tornado.gen.coroutine
     def get(self):
+        settings, users = yield [
+            db.settings_get(),
+            db.users_fetch()]
         self.render('about.html',
-            settings=db.settings_get(),
-            users=db.users_fetch())
+            settings=settings,
+            users=users)
 
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def post(self):
         self.authorize('moderate')
-        settings = db.settings_get()
+        settings = yield db.settings_get()
         settings['motd'] = self.get_argument('motd', None)
         settings['about'] = self.get_argument('about', None)
-        db.settings_save(settings)
+        yield db.settings_save(settings)
         self.reload(message="It has been done, m'lord.")
 
 
 class Feeds(BaseHandler):
+    @tornado.gen.coroutine
     def get(self):
-        self.render('feeds.html', feeds=db.feeds_fetch())
+        feeds = yield db.feeds_fetch()
+        self.render('feeds.html', feeds=feeds)
 
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def post(self):
         self.authorize('moderate')
         action = self.get_argument('action', None)
@@ -475,28 +687,106 @@ class Feeds(BaseHandler):
         url = self.get_argument('url', None)
         
         if action == 'create':
-            db.feed_create(id=id, url=url)
+            yield db.feed_create(id=id, url=url)
         elif action == 'edit':
-            feed = db.feed_get(id)
+            feed = yield db.feed_get(id)
             if not feed:
                 raise tornado.web.HTTPError(404)
             feed['id'] = new_id
             feed['url'] = url
-            f = db.feed_replace(id, feed)
+            f = yield db.feed_replace(id, feed)
             logging.info(str(f))
         elif action == 'remove':
-            db.feed_delete(id)
+            yield db.feed_delete(id)
         self.reload(message='Feeds updated')
 
 
+class Metrics(BaseHandler):
+    """Timings and cache stats for Prometheus, for the metrics_token"""
+    def prepare(self):
+        # Scrapes don't need the user or the tag counts
+        pass
+
+    def get(self):
+        token = settings.get('metrics_token')
+        auth = self.request.headers.get('Authorization', '')
+        # Only the header, a query string token would end up in access logs
+        given = auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+        if not token or not hmac.compare_digest(
+            tornado.escape.utf8(given), tornado.escape.utf8(token)):
+            raise tornado.web.HTTPError(403)
+        gauges = {'requests_active': requests_active}
+        for name, cache in (('page_cache', page_cache), ('user_cache', db.user_cache)):
+            for stat, value in cache.stats().items():
+                gauges[name + '_' + stat] = value
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(utils.metrics.text(gauges))
+
+
+class StaticFileHandler(tornado.web.StaticFileHandler):
+    """
+    Serves files built by utils.build_assets under their hashed names,
+    cached for as long as browsers allow, and picks their .br or .gz
+    version when the browser accepts it.
+    """
+    _manifest = None
+
+    @classmethod
+    def manifest(cls, static_path):
+        if cls._manifest is None:
+            try:
+                with open(os.path.join(static_path, 'build', 'manifest.json')) as f:
+                    cls._manifest = json.load(f)
+            except IOError:
+                cls._manifest = {}
+        return cls._manifest
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        built = cls.manifest(settings['static_path']).get(path)
+        if built:
+            return settings.get('static_url_prefix', '/static/') + built
+        return super(StaticFileHandler, cls).make_static_url(
+            settings, path, include_version)
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(StaticFileHandler, self).validate_absolute_path(
+            root, absolute_path)
+        if self.path.startswith('build/'):
+            self.set_header('Vary', 'Accept-Encoding')
+            accepted = self.request.headers.get('Accept-Encoding', '')
+            for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+                if encoding in accepted and os.path.isfile(absolute_path + ext):
+                    self.set_header('Content-Encoding', encoding)
+                    return absolute_path + ext
+        return absolute_path
+
+    def get_content_type(self):
+        # The type of the file itself, not of its compressed version
+        mime_type, encoding = mimetypes.guess_type(self.path)
+        return mime_type or 'application/octet-stream'
+
+    def get_cache_time(self, path, modified, mime_type):
+        if path.startswith('build/'):
+            return self.CACHE_MAX_AGE
+        return super(StaticFileHandler, self).get_cache_time(
+            path, modified, mime_type)
+
+    def set_extra_headers(self, path):
+        if path.startswith('build/'):
+            # A new build gets new names, so these never change
+            self.set_header('Cache-Control', 'public, max-age=' +
+                str(self.CACHE_MAX_AGE) + ', immutable')
+
+
 class GitHubHook(BaseHandler):
     def post(self):
         # TODO: add hash verification
         logging.info(str(self.request))
-        subprocess.call(
-            'git pull && sudo restart nohuck',
-            shell=True,
-            cwd=os.getcwd())
+        subprocess.call('git pull', shell=True, cwd=os.getcwd())
+        subprocess.call([sys.executable, 'main.py', 'build'], cwd=os.getcwd())
+        # Don't wait for the restart, it waits for this request to finish
+        subprocess.Popen('sudo restart nohuck', shell=True, cwd=os.getcwd())
         self.write('1')
     
     def check_xsrf_cookie(self):
@@ -513,6 +803,8 @@ routes = [
     (r'/about', About),
     (r'/feeds', Feeds),
     (r'/_webhook', GitHubHook),
+    (r'/_metrics', Metrics),
+    (r'/api/videos', VideosApi),
     (r'/tags', Tags),
     (r'/tags/(?P<tag_slug>[^\/]+)/(?P<id>\d+)', Video),
     (r'/tags/(?P<tag_slug>[^\/]+)/(?P<id>\d+)/edit', AddOrEditVideo),
@@ -524,24 +816,169 @@ routes = [
 config = {
     'template_path': 'templates',
     'static_path': 'static',
+    'static_handler_class': StaticFileHandler,
+    'compress_response': True,
     'xsrf_cookies': True,
     'debug': True,
-    'cookie_secret': settings['cookie_secret'],
     'login_url': '/login'
 }
 
 
+def load_settings():
+    settings.update(tornado.ioloop.IOLoop.current().run_sync(db.settings_get))
+    utils.youtube_api_key = settings['youtube_api_key']
+    config['cookie_secret'] = settings['cookie_secret']
+    db.rankings_load(settings.get('rankings') or {})
+
+
+@tornado.gen.coroutine
+def shutdown(server, timeout=10):
+    """Stops taking connections and waits for running requests to finish"""
+    server.stop()
+    deadline = time.time() + timeout
+    while requests_active and time.time() < deadline:
+        yield tornado.gen.sleep(0.1)
+    db.pool.close()
+    tornado.ioloop.IOLoop.current().stop()
+
+
+# In the parent process, the task ids of the running workers by pid
+worker_pids = {}
+workers_stopping = False
+
+
+def fork_workers(n, max_restarts=100):
+    """
+    Forks n workers and returns the task id, 0 to n - 1, in each of them.
+    The parent waits on the workers, restarting any that crash, and
+    exits once they have all stopped. Like tornado.process.fork_processes
+    but the parent keeps the pids, so it can signal just its workers.
+    """
+    def start(task_id):
+        pid = os.fork()
+        if pid == 0:
+            worker_pids.clear()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            return True
+        worker_pids[pid] = task_id
+        return False
+
+    for task_id in range(n):
+        if start(task_id):
+            return task_id
+    restarts = 0
+    while worker_pids:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            # Interrupted by SIGTERM on Python 2
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in worker_pids:
+            continue
+        task_id = worker_pids.pop(pid)
+        if os.WIFSIGNALED(status):
+            logging.warning('worker %d (pid %d) killed by signal %d',
+                task_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('worker %d (pid %d) exited with status %d',
+                task_id, pid, os.WEXITSTATUS(status))
+        else:
+            logging.info('worker %d (pid %d) exited', task_id, pid)
+            continue
+        if workers_stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('too many worker restarts, giving up')
+        if start(task_id):
+            return task_id
+    sys.exit(0)
+
+
+def stop_workers(signum, frame):
+    """Passes SIGTERM on from the parent process to the workers"""
+    global workers_stopping
+    workers_stopping = True
+    for pid in list(worker_pids):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
     if 'prod' in sys.argv:
         logging.getLogger().setLevel(logging.ERROR)
         config['debug'] = False
+    if 'setup' in sys.argv:
+        tornado.ioloop.IOLoop.current().run_sync(db.setup)
+        sys.exit()
+    if 'build' in sys.argv:
+        utils.build_assets(config['static_path'])
+        sys.exit()
+    if 'rescore' in sys.argv:
+        # e.g. main.py rescore score=experiments.hot_score, or score= for
+        # the default. The functions are kept in settings so the servers
+        # score likes with them too.
+        load_settings()
+        paths = dict(settings.get('rankings') or {})
+        for arg in sys.argv:
+            if '=' in arg:
+                field, path = arg.split('=', 1)
+                if path:
+                    paths[field] = path
+                else:
+                    paths.pop(field, None)
+        db.rankings_load(paths)
+        if paths != (settings.get('rankings') or {}):
+            settings['rankings'] = paths
+            tornado.ioloop.IOLoop.current().run_sync(
+                lambda: db.settings_save(settings))
+            logging.warning('ranking functions changed, restart the servers '
+                'so they score likes with them')
+        tornado.ioloop.IOLoop.current().run_sync(db.videos_rescore)
+        sys.exit()
     if 'cron' in sys.argv:
-        tornado.ioloop.IOLoop.instance().run_sync(db.feeds_update)
+        load_settings()
+        if not tornado.ioloop.IOLoop.instance().run_sync(db.feeds_update):
+            sys.exit(1)
     else:
+        workers = 1
+        for arg in sys.argv:
+            if arg.startswith('workers='):
+                workers = int(arg.split('=', 1)[1])
+        sockets = tornado.netutil.bind_sockets(7000, address='127.0.0.1')
+        task_id = 0
+        if workers > 1:
+            # Autoreload can't restart forked workers
+            config['autoreload'] = False
+            signal.signal(signal.SIGTERM, stop_workers)
+            # Blocks in the parent, restarting workers that crash
+            task_id = fork_workers(workers)
+        # Everything that opens a connection or starts the IOLoop comes
+        # after the fork, so each worker has its own
+        load_settings()
         app = tornado.web.Application(routes, **config)
-        app.listen(7000, address='127.0.0.1', xheaders=True)
+        server = tornado.httpserver.HTTPServer(app, xheaders=True)
+        server.add_sockets(sockets)
+        signal.signal(signal.SIGTERM, lambda signum, frame:
+            tornado.ioloop.IOLoop.current().add_callback_from_signal(
+                shutdown, server))
+        # One crawler and job runner is enough, task 0 is restarted
+        # with the same id
+        if 'nocrawl' not in sys.argv and task_id == 0:
+            crawler = db.FeedCrawler()
+            tornado.ioloop.IOLoop.current().spawn_callback(crawler.run)
+        if task_id == 0:
+            jobs = db.JobRunner()
+            tornado.ioloop.IOLoop.current().spawn_callback(jobs.run)
+        # Either one sees writes from the other workers and from cron
+        if 'replica' in sys.argv:
+            tornado.ioloop.IOLoop.current().spawn_callback(db.replica.run)
+        else:
+            tornado.ioloop.IOLoop.current().spawn_callback(db.videos_watch)
         print('Running on localhost:7000...')
         tornado.ioloop.IOLoop.current().start()
-
-
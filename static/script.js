@@ -12,6 +12,15 @@ $(function(){
 	        $('.tab_content').hide();
 	        $($(this).attr('href')).show();
 	        return false;
+	    })
+	    .on('click', '.tab_content .next_page:not([data-after])', function(){
+	        // Load the next page of a profile list into its tab
+	        var $link = $(this),
+	            tab = '#' + $link.closest('.tab_content').attr('id');
+	        $.get($link.attr('href'), function(html){
+	            $link.replaceWith($(html).find(tab).children());
+	        });
+	        return false;
 	    })
 		.on('click', '.edit_btn', function(){
 			$(this).parent()
@@ -43,6 +52,17 @@ $(function(){
 			$('#sidebar .motd').hide();
 		});
 
+    $(document).on('click', '.next_page[data-after]', function(){
+        loadMoreVideos($(this));
+        return false;
+    });
+    $(window).on('scroll', function(){
+        var $link = $('.next_page[data-after]:visible');
+        if ($link.length && $(window).scrollTop() + $(window).height() >
+            $link.offset().top - 600)
+            loadMoreVideos($link);
+    });
+
     $('.more_tags').click(function(){
         $('.filter_nav .expand').toggle();
         return false;
@@ -62,6 +82,93 @@ $(function(){
 });
 
 
+// Appends the next page of a listing from /api/videos in place of
+// following a next_page link
+function loadMoreVideos($link){
+    if ($link.hasClass('loading'))
+        return;
+    $link.addClass('loading');
+    var tags = String($link.data('tags') || '');
+    $.ajax({
+        url: '/api/videos',
+        data: {
+            sort: $link.data('sort'),
+            after: $link.data('after'),
+            tag: tags ? tags.split('+') : []
+        },
+        traditional: true,
+        dataType: 'json'
+    }).done(function(data){
+        var $list = $link.prev('.videos');
+        $.each(data.videos, function(i, vid){
+            if ($list.length)
+                $list.append(vidItem(vid));
+            else
+                $link.before(vidItem(vid));
+        });
+        if (data.next) {
+            $link.data('after', data.next)
+                .attr('href', $link.attr('href')
+                    .replace(/after=[^&]*/, 'after=' + encodeURIComponent(data.next)))
+                .removeClass('loading');
+        } else {
+            $link.remove();
+        }
+    }).fail(function(){
+        $link.removeClass('loading');
+    });
+}
+
+
+// Builds the same markup as _vid_item.html
+function vidItem(vid){
+    var $item = $('<div class="vid_item">');
+    $('<a class="thumb">')
+        .attr('href', vid.url)
+        .css('background-image', 'url("' + vid.thumbnail.replace(/"/g, '%22') + '")')
+        .appendTo($item);
+    var $deets = $('<div class="deets">').appendTo($item);
+    $('<a class="title">')
+        .attr({href: vid.url, title: vid.title})
+        .text(vid.title)
+        .appendTo($deets);
+    var $submitted = $('<div class="submitted">')
+        .text(vid.points > 1 ? vid.points + ' points ' : 'submitted ')
+        .appendTo($deets);
+    var $more = $('<span class="more">').appendTo($submitted);
+    if (vid.user_id) {
+        $more.append('by ', $('<a>').attr('href', '/@' + vid.user_id).text(vid.user_id));
+    } else if (vid.feed) {
+        $more.append('via ', $('<a href="/feeds" rel="nofollow" target="_blank">').text(vid.feed));
+    }
+    $submitted.append(' ' + relativeDate(vid.created) + ' ');
+    if (vid.n_comments)
+        $('<span class="more">')
+            .text('- ' + vid.n_comments + (vid.n_comments == 1 ? ' comment' : ' comments'))
+            .appendTo($submitted);
+    $item.append('<div class="clearfix"></div>');
+    return $item;
+}
+
+
+// Matches BaseHandler.relative_date
+function relativeDate(seconds){
+    var units = [
+        [365 * 24 * 60 * 60, 'year'],
+        [30 * 24 * 60 * 60, 'month'],
+        [24 * 60 * 60, 'day'],
+        [60 * 60, 'hour'],
+        [60, 'minute']];
+    seconds = new Date().getTime() / 1000 - seconds;
+    for (var i=0, unit; unit=units[i]; i++){
+        var n = Math.floor(seconds / unit[0]);
+        if (n >= 1)
+            return n + ' ' + unit[1] + (n >= 2 ? 's ago' : ' ago');
+    }
+    return Math.floor(seconds) + ' seconds ago';
+}
+
+
 function nameGenerator(){
     var adjectives = ['Narly', 'Arrogant', 'Fickle', 'Eager', 'Modest', 'Greasy', 'Tart', 'Swift', 'Quaint', 'Unslightly', 'Fancy', 'Brave', 'Delightful', 'Jolly', 'Shy', 'Itchy', 'Obedient', 'Voiceless', 'Raspy', 'Silly', 'Powerful', 'Tender', 'Clumsy', 'Juicy', 'Bitter', 'Damp', 'Fluffy', 'Substantial', 'Sticky', 'Ancient', 'Foolish', 'Friendly'];
     var nouns = ['Carrot', 'Barley', 'Banana', 'Garlic', 'Pickle', 'Mouse', 'Baboon', 'Herring', 'Tramp', 'Panda', 'Owl', 'Parsnip', 'Whale', 'Lettuce', 'Yam', 'Mammoth', 'Rock', 'Mushroom', 'Elephant', 'Panther', 'Phoenix', 'Onion', 'Cloth', 'Chair', 'Lemonade', 'Tyvek', 'Underpants', 'Willow', 'Girdle', 'Clover', 'Beaver', 'Tart', 'Wolf', 'Leather', 'Pantyhose', 'Socks'];